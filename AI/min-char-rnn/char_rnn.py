@@ -0,0 +1,356 @@
+"""
+Minimal character-level Vanilla RNN model. Written by Andrej Karpathy (@karpathy)
+BSD License
+
+The model of min-char-rnn.py as an importable module:
+
+  from char_rnn import CharRNN, load_corpus
+  data, chars = load_corpus('input.txt')
+  model = CharRNN(len(chars))
+  loss, grads, hprev = model.loss_and_grads(inputs, targets, hprev)
+  model.step(grads)
+
+min-char-rnn.py is the training script built on top of it.
+"""
+
+## add comments by weixsong
+## reference page [The Unreasonable Effectiveness of Recurrent Neural Networks](http://karpathy.github.io/2015/05/21/rnn-effectiveness/)
+
+## this is a 3 layers neuron network.
+## input layer: one hot vector, dim: vocab * 1
+## hidden layer: LSTM, hidden vector: hidden_size * 1
+## output layer: Softmax, vocab * 1, the probabilities distribution of each character
+
+import io
+import json
+import os
+
+import numpy as np
+
+## encode the corpus once into a file of vocabulary indices, so training never touches the text again
+def encode_corpus(txt_path, chars=None, chunk_chars=1 << 24):
+  """
+  write the characters of txt_path as vocabulary indices to a .npy file next to it,
+  and the vocabulary (list of characters, index order) to a .vocab.json file.
+  chars is the vocabulary to encode with (e.g. the training vocabulary for a validation
+  file); by default it is built from the file itself.
+  the text is read in chunks of chunk_chars characters, so it never has to fit in memory.
+  returns the paths of the .npy and .vocab.json files
+  """
+  base = os.path.splitext(txt_path)[0]
+  npy_path, vocab_path = base + '.npy', base + '.vocab.json'
+
+  ## first pass: collect the vocabulary and count the characters
+  seen, n_chars = set(), 0
+  with io.open(txt_path, 'r', encoding='utf-8') as f:
+    for chunk in iter(lambda: f.read(chunk_chars), u''):
+      seen.update(chunk)
+      n_chars += len(chunk)
+  if chars is None:
+    chars = sorted(seen)
+  elif not seen.issubset(chars):
+    raise ValueError('%s has characters outside the vocabulary: %r' % (txt_path, ''.join(sorted(seen.difference(chars)))))
+  if len(chars) > 65536:
+    raise ValueError('%s has %d unique characters, more than uint16 can index' % (txt_path, len(chars)))
+  dtype = np.uint8 if len(chars) <= 256 else np.uint16
+
+  ## lookup table from unicode codepoint to vocabulary index
+  codepoints = np.array([ord(ch) for ch in chars])
+  lut = np.zeros(codepoints.max() + 1, dtype=dtype)
+  lut[codepoints] = np.arange(len(chars))
+
+  ## second pass: encode chunk by chunk into a temporary file. it is renamed to the .npy last, after the
+  ## vocabulary is written, so an interrupted encoding leaves no .npy that load_corpus would take as current
+  out = np.lib.format.open_memmap(npy_path + '.tmp', mode='w+', dtype=dtype, shape=(n_chars,))
+  pos = 0
+  with io.open(txt_path, 'r', encoding='utf-8') as f:
+    for chunk in iter(lambda: f.read(chunk_chars), u''):
+      ## utf-32 gives one fixed-width codepoint per character, no per-character python loop
+      cps = np.frombuffer(chunk.encode('utf-32-le'), dtype='<u4')
+      out[pos : pos + len(cps)] = lut[cps]
+      pos += len(cps)
+  out.flush()
+  del out
+
+  with io.open(vocab_path, 'w', encoding='utf-8') as f:
+    f.write(json.dumps(list(chars), ensure_ascii=False))
+  os.replace(npy_path + '.tmp', npy_path)
+  return npy_path, vocab_path
+
+def load_corpus(txt_path, chars=None):
+  """
+  the encoded corpus of txt_path as a read-only memmap of vocabulary indices, and its vocabulary.
+  encodes it first (see encode_corpus) when there is no encoded copy, or the text is newer,
+  or chars is given and differs from the saved vocabulary.
+  """
+  base = os.path.splitext(txt_path)[0]
+  npy_path, vocab_path = base + '.npy', base + '.vocab.json'
+  ## re-encode only when the text is newer than the encoded copy
+  stale = not (os.path.exists(npy_path) and os.path.exists(vocab_path)) or os.path.getmtime(npy_path) < os.path.getmtime(txt_path)
+  if not stale:
+    with io.open(vocab_path, 'r', encoding='utf-8') as f:
+      stale = chars is not None and json.load(f) != list(chars)
+  if stale:
+    encode_corpus(txt_path, chars)
+  ## memory-mapped, read-only: slices are views into the file, and the corpus can be larger than RAM
+  data = np.load(npy_path, mmap_mode='r')
+  with io.open(vocab_path, 'r', encoding='utf-8') as f:
+    chars = json.load(f)
+  return data, chars
+
+class CharRNN(object):
+  """
+  vanilla RNN over a vocabulary of vocab_size characters, trained with Adagrad.
+  inputs and targets are (seq_length, B) integer arrays for B streams trained together
+  (a plain list of integers is one stream), hidden states are HxB arrays.
+  """
+  param_names = ['Wxh', 'Whh', 'Why', 'bh', 'by']
+  memory_names = ['mWxh', 'mWhh', 'mWhy', 'mbh', 'mby']
+
+  def __init__(self, vocab_size, hidden_size=100, learning_rate=1e-1, dtype=np.float64, loss_dtype=np.float64, rng=np.random):
+    """
+    dtype is the precision of the parameters, gradients and Adagrad memories;
+    loss_dtype the precision the loss is summed in.
+    rng is anything with randn (np.random or a np.random.RandomState) for the initial weights.
+    """
+    self.vocab_size = vocab_size
+    self.hidden_size = hidden_size
+    self.learning_rate = learning_rate
+    self.dtype = dtype
+    self.loss_dtype = loss_dtype
+
+    # model parameters
+    ## RNN/LSTM
+    ## this is not LSTM, is the simple basic RNN
+    ## # update the hidden state
+    ## self.h = np.tanh(np.dot(self.W_hh, self.h) + np.dot(self.W_xh, x))
+    ## # compute the output vector
+    ## y = np.dot(self.W_hy, self.h)
+    self.Wxh = (rng.randn(hidden_size, vocab_size)*0.01).astype(dtype) # input to hidden #Randomly initialized.
+    self.Whh = (rng.randn(hidden_size, hidden_size)*0.01).astype(dtype) # hidden to hidden
+    self.Why = (rng.randn(vocab_size, hidden_size)*0.01).astype(dtype) # hidden to output
+    self.bh = np.zeros((hidden_size, 1), dtype=dtype) # hidden bias
+    self.by = np.zeros((vocab_size, 1), dtype=dtype) # output bias
+
+    self.mWxh, self.mWhh, self.mWhy = np.zeros_like(self.Wxh), np.zeros_like(self.Whh), np.zeros_like(self.Why)
+    self.mbh, self.mby = np.zeros_like(self.bh), np.zeros_like(self.by) # memory variables for Adagrad
+
+  def arrays(self):
+    """ parameters and Adagrad memories by name, in param_names + memory_names order """
+    return [(name, getattr(self, name)) for name in self.param_names + self.memory_names]
+
+  def init_hidden(self, batch_size=1):
+    return np.zeros((self.hidden_size, batch_size), dtype=self.dtype)
+
+  ## compute loss, derivative
+  ## cross-entropy loss is used
+  ## actually, here the author use cross-entropy as error,
+  ## but in the backpropagation the author use sum of squared error (Quadratic cost) to do back propagation.
+  ## be careful about this trick.
+  ## this is because the output layer is a linear layer.
+  ## TRICK: Using the quadratic cost when we have linear neurons in the output layer, z[i] = a[i]
+  def loss_and_grads(self, inputs, targets, hprev):
+    """
+    inputs,targets are both list of integers, or (seq_length, B) integer arrays for B streams.
+    hprev is HxB array of initial hidden state (Hx1 for a single stream)
+    returns the loss, the clipped gradients (dWxh, dWhh, dWhy, dbh, dby) and last hidden state
+    loss and gradients are averaged over the B streams.
+    """
+    inputs = np.asarray(inputs).reshape(len(inputs), -1)
+    targets = np.asarray(targets).reshape(len(targets), -1)
+    loss, hs, ps = self.forward(inputs, targets, hprev)
+    grads = self.backward(inputs, targets, hs, ps)
+    self.clip(grads)
+    return loss, grads, hs[-1].T.copy()
+
+  ## loss_and_grads is split into the phases below so that each one can be timed on its own
+  def forward(self, inputs, targets, hprev):
+    """
+    inputs,targets are (seq_length, B) integer arrays, hprev is HxB
+    returns the loss averaged over the B streams, the hidden states hs and the softmax outputs ps
+    """
+    n_steps, B = inputs.shape
+    hidden_size = self.hidden_size
+    ## hidden states and output probabilities live in preallocated arrays instead of dicts.
+    ## hs[0] is hprev and hs[t+1] is the hidden state after reading inputs[t].
+    ## states are stored one row per stream, hs[t] is BxH, so hs[1:] can be viewed as a
+    ## stacked (seq_length*B, H) matrix for the weight gradients below.
+    hs = np.zeros((n_steps + 1, B, hidden_size), dtype=self.dtype)
+    hs[0] = hprev.T
+
+    ## np.dot(Wxh, one_hot(inputs[t])) is just column inputs[t] of Wxh, so the input projection
+    ## of the whole sequence is one gather, done before the recurrence. bh is folded in here too.
+    xs = self.Wxh.T[inputs] + self.bh.T # (seq_length, B, H)
+
+    # forward pass for each training data point
+    ## only the recurrence itself has to go step by step
+    WhhT = self.Whh.T
+    for t in range(n_steps):
+      ## hidden state, using previous hidden state hs[t]
+      hs[t+1] = np.tanh(xs[t] + np.dot(hs[t], WhhT))
+
+    ## everything after the recurrence is done for all steps at once
+    H_all = hs[1:].reshape(-1, hidden_size) # (seq_length*B, H)
+    ## unnormalized log probabilities for next chars
+    ys = np.dot(H_all, self.Why.T) + self.by.T
+    ## probabilities for next chars, softmax
+    ## subtracting the max does not change the softmax and keeps exp from overflowing in float32
+    ys -= ys.max(axis=1, keepdims=True)
+    ps = np.exp(ys)
+    sums = np.sum(ps, axis=1, keepdims=True)
+    ps /= sums
+    rows = np.arange(n_steps * B)
+    ## softmax (cross-entropy loss)
+    ## -log(ps[target]) taken as log(sum) - ys[target], so it stays finite when ps underflows
+    loss = np.sum(np.log(sums[:, 0]) - ys[rows, targets.ravel()], dtype=self.loss_dtype)
+    return loss / B, hs, ps
+
+  def backward(self, inputs, targets, hs, ps):
+    """
+    gradients of the loss on (Wxh, Whh, Why, bh, by), averaged over the B streams
+    hs and ps are the outputs of forward(); ps is overwritten
+    """
+    n_steps, B = inputs.shape
+    hidden_size = self.hidden_size
+    H_all = hs[1:].reshape(-1, hidden_size)
+    rows = np.arange(n_steps * B)
+
+    # backward pass: compute gradients going backwards
+    ## compute derivative of error w.r.t the output probabilites
+    ## dE/dy[j] = y[j] - t[j]
+    dys = ps
+    dys[rows, targets.ravel()] -= 1 # backprop into y
+    ## derivative of H coming from the output layer, for every step at once
+    dhs_out = np.dot(dys, self.Why).reshape(n_steps, B, hidden_size)
+
+    dhraws = np.zeros((n_steps, B, hidden_size), dtype=self.dtype)
+    dhnext = np.zeros((B, hidden_size), dtype=self.dtype)
+    for t in reversed(range(n_steps)):
+      ## backprop into h
+      ## derivative of error with regard to the output of hidden layer
+      ## derivative of H, come from output layer y and also come from H(t+1), the next time H
+      dh = dhs_out[t] + dhnext
+      ## backprop through tanh nonlinearity
+      ## derivative of error with regard to the input of hidden layer
+      ## dtanh(x)/dx = 1 - tanh(x) * tanh(x)
+      dhraws[t] = (1 - hs[t+1] * hs[t+1]) * dh
+      ## derivative of the error with regard to H(t+1)
+      ## or derivative of the error of H(t-1) with regard to H(t)
+      dhnext = np.dot(dhraws[t], self.Whh)
+
+    ## the weight gradients are sums of outer products over the steps, so each one is a single
+    ## matrix multiply of the stacked (seq_length*B, .) activations.
+    dhraw_all = dhraws.reshape(-1, hidden_size)
+    ## output layer doesnot use activation function, so no need to compute the derivative of error with regard to the net input
+    ## of output layer.
+    ## then, we could directly compute the derivative of error with regard to the weight between hidden layer and output layer.
+    ## dE/dy[j]*dy[j]/dWhy[j,k] = dE/dy[j] * h[k]
+    dWhy = np.dot(dys.T, H_all)
+    dby = np.sum(dys, axis=0).reshape(self.by.shape)
+    dWhh = np.dot(dhraw_all.T, hs[:-1].reshape(-1, hidden_size))
+    dbh = np.sum(dhraw_all, axis=0).reshape(self.bh.shape)
+    ## derivative of the error with regard to the weight between input layer and hidden layer
+    ## the one-hot input only touches column inputs[t], so scatter-add dhraw into that column.
+    ## np.add.at keeps the sum right when the same character shows up more than once.
+    dWxh = np.zeros_like(self.Wxh)
+    np.add.at(dWxh.T, inputs.ravel(), dhraw_all)
+
+    ## average over streams so the Adagrad step size does not depend on batch_size
+    for dparam in [dWxh, dWhh, dWhy, dbh, dby]:
+      dparam /= B
+    return dWxh, dWhh, dWhy, dbh, dby
+
+  @staticmethod
+  def clip(grads):
+    for dparam in grads:
+      np.clip(dparam, -5, 5, out=dparam) # clip to mitigate exploding gradients
+
+  # perform parameter update with Adagrad
+  def step(self, grads):
+    """ Adagrad update of the parameters with grads = (dWxh, dWhh, dWhy, dbh, dby) """
+    ## parameter update for Adagrad is different from gradient descent parameter update
+    ## need to learn what is Adagrad exactly is.
+    ## seems using weight matrix, derivative of weight matrix and a memory matrix, update memory matrix each iteration
+    ## memory is the accumulation of each squared derivatives in each iteration.
+    ## mem += dparam * dparam
+    ## in Hogwild mode these arrays are shared by all workers and updated without any lock.
+    for param, dparam, mem in zip([self.Wxh, self.Whh, self.Why, self.bh, self.by],
+                                  grads,
+                                  [self.mWxh, self.mWhh, self.mWhy, self.mbh, self.mby]):
+      mem += dparam * dparam
+      ## learning_rate is adjusted by mem, if mem is getting bigger, then learning_rate will be small
+      ## gradient descent of Adagrad
+      param += -self.learning_rate * dparam / np.sqrt(mem + 1e-8) # adagrad update
+
+  ## given a hidden RNN state, and a input char id, predict the coming n chars
+  ## K sequences are sampled together, one per column of h
+  def sample(self, h, seed_ix, n, temperature=1.0):
+    """
+    sample K sequences of integers from the model
+    h is HxK memory state, seed_ix is seed letter (or K seed letters) for first time step
+    temperature < 1 makes the samples more conservative, > 1 more random
+    returns a K x n array of character indices
+    """
+    K = h.shape[1]
+    offsets = np.arange(K)
+
+    ## the input is the index of the one-hot position; Wxh[:, ix] is np.dot(Wxh, one_hot)
+    ix = np.array(np.broadcast_to(seed_ix, (K,)))
+    ## all the uniform randoms for the draws, generated up front
+    u = np.random.random_sample((n, K))
+
+    ixes = np.zeros((n, K), dtype=int)
+    for t in range(n):
+      ## self.h = np.tanh(np.dot(self.W_hh, self.h) + np.dot(self.W_xh, x))
+      h = np.tanh(self.Wxh[:, ix] + np.dot(self.Whh, h) + self.bh)
+      ## y = np.dot(self.W_hy, self.h)
+      y = (np.dot(self.Why, h) + self.by) / temperature
+      ## softmax, left unnormalized: the cumulative sum is normalized instead
+      p = np.exp(y - y.max(axis=0))
+      cdf = np.cumsum(p, axis=0)
+      ## sample according to probability distribution: find where u falls in each column's cdf.
+      ## shifting column k by k makes the flattened cdfs one sorted array, so one
+      ## searchsorted call draws for all K sequences.
+      cdf = (cdf / cdf[-1] + offsets).T.ravel()
+      ix = np.searchsorted(cdf, u[t] + offsets, side='right') - offsets * self.vocab_size
+      ## guard against u landing past the last cdf entry through rounding
+      ix = np.minimum(ix, self.vocab_size - 1)
+
+      ## use the new sampled result as last input, then predict next char again.
+
+      ixes[t] = ix
+
+    return ixes.T
+
+  ## held-out evaluation: forward pass only, nothing kept for a backward pass
+  def evaluate(self, data, chunk_size=1 << 16, batch_size=1):
+    """
+    average loss per character (in nats) and perplexity of the model on data, a 1-D
+    array of character indices (e.g. a memmap from load_corpus).
+    data is split into batch_size streams, each starting from a zero hidden state, and
+    read chunk_size characters at a time; the hidden state is carried across chunks.
+    batch_size = 1 scores every character with its full left context; larger values turn
+    the recurrence into matrix-matrix products at the cost of batch_size - 1 cold starts.
+    """
+    stream_size = len(data) // batch_size
+    streams = np.asarray(data[:stream_size * batch_size]).reshape(batch_size, stream_size)
+    h = np.zeros((batch_size, self.hidden_size), dtype=self.dtype)
+    WhhT, WhyT = self.Whh.T, self.Why.T
+    total, count = 0.0, 0
+    for start in range(0, stream_size - 1, chunk_size):
+      ## (T, B) windows, targets are the inputs shifted by one
+      window = streams[:, start : start + chunk_size + 1].T
+      inputs, targets = window[:-1], window[1:]
+      xs = self.Wxh.T[inputs] + self.bh.T
+      hs = np.empty((len(inputs), batch_size, self.hidden_size), dtype=self.dtype)
+      for t in range(len(inputs)):
+        h = np.tanh(xs[t] + np.dot(h, WhhT))
+        hs[t] = h
+      ## log-softmax of the whole chunk at once
+      ys = np.dot(hs.reshape(-1, self.hidden_size), WhyT) + self.by.T
+      ys -= ys.max(axis=1, keepdims=True)
+      logsums = np.log(np.sum(np.exp(ys), axis=1))
+      total += np.sum(logsums - ys[np.arange(len(ys)), targets.ravel()], dtype=np.float64)
+      count += targets.size
+    loss = float(total / count)
+    return loss, float(np.exp(loss))
@@ -11,192 +11,369 @@ BSD License
 ## hidden layer: LSTM, hidden vector: hidden_size * 1
 ## output layer: Softmax, vocab * 1, the probabilities distribution of each character
 
+import argparse
+import glob
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from multiprocessing import shared_memory
+
+## number of BLAS threads per process, None keeps numpy's default (usually one per core).
+## it only takes effect before numpy is imported, so it is set here and not with the
+## hyperparameters below. with many training processes on one host (Hogwild workers, or
+## several runs) 1 avoids oversubscribing the cores on these small matrices.
+blas_threads = None
+if blas_threads is not None:
+  for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'BLIS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS']:
+    os.environ[var] = str(blas_threads)
+
 import numpy as np
 
-# data I/O
-data = open('input.txt', 'r').read() # should be simple plain text file
+from char_rnn import CharRNN, load_corpus
 
-# use set() to count the vacab size
-chars = list(set(data))
+# data I/O
+corpus_path = 'input.txt' # should be simple plain text file
+## held-out text to report perplexity on, encoded with the training vocabulary; None to skip
+val_path = None
+data, chars = load_corpus(corpus_path)
 data_size, vocab_size = len(data), len(chars)
 
 #Prem: what ancient script is this?
-print 'data has %d characters, %d unique.' % (data_size, vocab_size)
+print('data has %d characters, %d unique.' % (data_size, vocab_size))
 
 # dictionary to convert char to idx, idx to char
 char_to_ix = { ch:i for i,ch in enumerate(chars) }
 ix_to_char = { i:ch for i,ch in enumerate(chars) }
 
+val_data = load_corpus(val_path, chars)[0] if val_path is not None else None
+
 # hyperparameters
 hidden_size = 100 # size of hidden layer of neurons
 seq_length = 25 # number of steps to unroll the RNN for. P:?
 learning_rate = 1e-1
+batch_size = 1 # number of independent streams trained together, each starting at a different offset of the data
+num_workers = 1 # > 1 trains Hogwild-style: worker processes share the parameters and update them without locks
+report_every = 10.0 # seconds between progress reports when num_workers > 1
+dtype = np.float64 # precision of the parameters, gradients and Adagrad memories; np.float32 halves memory traffic
+loss_dtype = np.float64 # precision the loss is summed in; set to dtype to skip the float64 accumulation
+eval_every = 1000 # iterations between validation perplexity reports, when val_path is set
+checkpoint_dir = 'checkpoints' # where the .npz snapshots go
+checkpoint_every = 1000 # iterations between snapshots (in Hogwild mode a snapshot is taken at every report)
+keep_checkpoints = 3 # older snapshots are deleted
 
 # model parameters
-## RNN/LSTM
-## this is not LSTM, is the simple basic RNN
-## # update the hidden state
-## self.h = np.tanh(np.dot(self.W_hh, self.h) + np.dot(self.W_xh, x))
-## # compute the output vector
-## y = np.dot(self.W_hy, self.h)
-Wxh = np.random.randn(hidden_size, vocab_size)*0.01 # input to hidden #Randomly initialized.
-Whh = np.random.randn(hidden_size, hidden_size)*0.01 # hidden to hidden
-Why = np.random.randn(vocab_size, hidden_size)*0.01 # hidden to output
-bh = np.zeros((hidden_size, 1)) # hidden bias
-by = np.zeros((vocab_size, 1)) # output bias
-
-
-## compute loss, derivative
-## cross-entropy loss is used
-## actually, here the author use cross-entropy as error,
-## but in the backpropagation the author use sum of squared error (Quadratic cost) to do back propagation.
-## be careful about this trick. 
-## this is because the output layer is a linear layer.
-## TRICK: Using the quadratic cost when we have linear neurons in the output layer, z[i] = a[i]
-def lossFun(inputs, targets, hprev):
+## the model itself (parameters, loss and gradients, Adagrad, sampling) lives in char_rnn.py
+model = CharRNN(vocab_size, hidden_size, learning_rate, dtype, loss_dtype)
+
+## checkpoints: parameters, Adagrad memories and the loop state (hprev, p, n, smooth_loss) in one .npz
+def snapshot(model, n, p, hprev, smooth_loss):
+  """ copy of everything needed to resume training, safe to write while training goes on """
+  state = dict((name, arr.copy()) for name, arr in model.arrays())
+  state.update(hprev=hprev.copy(), p=p, n=n, smooth_loss=smooth_loss)
+  return state
+
+def latest_checkpoint(directory):
+  """ path of the newest snapshot in directory, or None """
+  paths = sorted(glob.glob(os.path.join(directory, 'ckpt_*.npz')))
+  return paths[-1] if paths else None
+
+def load_checkpoint(model, path):
+  """
+  copy the parameters and Adagrad memories of a snapshot into the model arrays (in place)
+  returns the loop state as a dict with hprev, p, n and smooth_loss
+  """
+  ckpt = np.load(path)
+  for name, arr in model.arrays():
+    if ckpt[name].shape != arr.shape:
+      raise ValueError('%s in %s has shape %s, the model has %s' % (name, path, ckpt[name].shape, arr.shape))
+    np.copyto(arr, ckpt[name])
+  return dict(hprev=ckpt['hprev'], p=int(ckpt['p']), n=int(ckpt['n']), smooth_loss=float(ckpt['smooth_loss']))
+
+class CheckpointWriter(object):
+  """
+  writes snapshots to disk in a background thread, so training never waits on disk.
+  at most one snapshot waits for the thread; if a newer one arrives first, the older one is dropped.
+  """
+  def __init__(self, directory, keep=keep_checkpoints):
+    self.directory = directory
+    self.keep = keep
+    self.queue = queue.Queue(maxsize=1)
+    os.makedirs(directory, exist_ok=True)
+    self.thread = threading.Thread(target=self._run, daemon=True)
+    self.thread.start()
+
+  def save(self, state):
+    try:
+      self.queue.get_nowait() # drop a snapshot that has not been written yet
+    except queue.Empty:
+      pass
+    self.queue.put_nowait(state)
+
+  def close(self):
+    """ write whatever is still queued and stop the thread """
+    self.queue.put(None)
+    self.thread.join()
+
+  def _run(self):
+    while True:
+      state = self.queue.get()
+      if state is None:
+        return
+      ## a failed write is reported and skipped; if it ended the thread, close() would wait forever
+      try:
+        self._write(state)
+      except Exception as e:
+        print('could not write the snapshot of iter %d: %s' % (state['n'], e))
+
+  def _write(self, state):
+    path = os.path.join(self.directory, 'ckpt_%09d.npz' % state['n'])
+    ## write to a temporary file and rename, so a kill mid-write never leaves a broken snapshot
+    with open(path + '.tmp', 'wb') as f:
+      np.savez(f, **state)
+    os.replace(path + '.tmp', path)
+    for old in sorted(glob.glob(os.path.join(self.directory, 'ckpt_*.npz')))[:-self.keep]:
+      os.remove(old)
+
+## split data into batch_size equal streams; row b of the result is stream b.
+## reshaping the memmap is a view, so no data is copied or loaded here.
+def make_streams(data, batch_size):
+  stream_size = len(data) // batch_size
+  return data[:stream_size * batch_size].reshape(batch_size, stream_size)
+
+## the training loop, run forever over one set of streams
+def train(model, streams, stats=None, worker=0, state=None, writer=None):
+  """
+  trains model on streams, a batch_size x stream_size array of character indices.
+  without stats this is the interactive loop that prints samples and progress.
+  as a Hogwild worker it prints nothing and instead writes its character count and
+  smooth loss to row `worker` of the shared stats array.
+  state is the loop state returned by load_checkpoint, to resume where a snapshot left off.
+  with a CheckpointWriter, a snapshot is handed to it every checkpoint_every iterations.
+  with val_data set, the perplexity on it is printed every eval_every iterations.
   """
-  inputs,targets are both list of integers.
-  hprev is Hx1 array of initial hidden state
-  returns the loss, gradients on model parameters, and last hidden state
+  ## iterator counter
+  n = 0
+  ## data pointer, relative to the start of each stream
+  p = 0
+  batch_size, stream_size = streams.shape
+  smooth_loss = -np.log(1.0/model.vocab_size)*seq_length # loss at iteration 0
+  if state is not None:
+    n, p, smooth_loss = state['n'], state['p'], state['smooth_loss']
+    hprev = state['hprev']
+    if hprev.shape != (model.hidden_size, batch_size):
+      raise ValueError('checkpoint hidden state has shape %s, expected %s' % (hprev.shape, (model.hidden_size, batch_size)))
+
+  ## main loop
+  while True:
+    # prepare inputs (we're sweeping from left to right in steps seq_length long)
+    if p + seq_length + 1 >= stream_size or n == 0:
+      # reset RNN memory
+      ## hprev is the hiddden state of RNN, one column per stream
+      hprev = model.init_hidden(batch_size)
+      # go from start of data
+      p = 0
+
+    ## (seq_length, batch_size) arrays of indices, column b is read from stream b.
+    ## both are views into the memmap, no per-character dictionary lookups.
+    window = streams[:, p : p + seq_length + 1].T
+    inputs, targets = window[:-1], window[1:]
+
+    # sample from the model now and then
+    if stats is None and n % 100 == 0:
+      sample_ix = model.sample(hprev[:, :1], inputs[0, 0], 200)[0]
+      txt = ''.join(ix_to_char[ix] for ix in sample_ix)
+      print('---- sample -----')
+      print('----\n %s \n----' % (txt, ))
+
+    # forward seq_length characters through the net and fetch gradient
+    loss, grads, hprev = model.loss_and_grads(inputs, targets, hprev)
+    ## author using Adagrad(a kind of gradient descent)
+    smooth_loss = smooth_loss * 0.999 + loss * 0.001
+    if stats is None:
+      if n % 100 == 0:
+        print('iter %d, loss: %f' % (n, smooth_loss)) # print progress
+    else:
+      stats[worker] = ((n + 1) * seq_length * batch_size, smooth_loss)
+
+    # perform parameter update with Adagrad
+    model.step(grads)
+
+    p += seq_length # move data pointer
+    n += 1 # iteration counter
+
+    if writer is not None and n % checkpoint_every == 0:
+      writer.save(snapshot(model, n, p, hprev, smooth_loss))
+    if stats is None and val_data is not None and n % eval_every == 0:
+      val_loss, perplexity = model.evaluate(val_data)
+      print('iter %d, val loss: %f per char, perplexity: %f' % (n, val_loss, perplexity))
+
+## entry point of a Hogwild worker process; Ctrl-C is left to the parent, which stops the workers
+def hogwild_worker(model, streams, stats, worker):
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  np.random.seed(worker)
+  train(model, streams, stats, worker)
+
+## copy arr into a new shared memory block; returns the block and an array backed by it
+def to_shared(arr):
+  shm = shared_memory.SharedMemory(create=True, size=arr.nbytes)
+  shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+  shared[...] = arr
+  return shm, shared
+
+## Hogwild training: num_workers processes, each on its own slice of the data
+def hogwild(model, num_workers, writer=None, state=None):
   """
-  xs, hs, ys, ps = {}, {}, {}, {}
-  ## record each hidden state of
-  hs[-1] = np.copy(hprev)
-  loss = 0
-  # forward pass for each training data point
-  for t in xrange(len(inputs)):
-    xs[t] = np.zeros((vocab_size, 1)) # encode in 1-of-k representation
-    xs[t][inputs[t]] = 1
-    
-    ## hidden state, using previous hidden state hs[t-1]
-    hs[t] = np.tanh(np.dot(Wxh, xs[t]) + np.dot(Whh, hs[t-1]) + bh)
-    ## unnormalized log probabilities for next chars
-    ys[t] = np.dot(Why, hs[t]) + by
-    ## probabilities for next chars, softmax
-    ps[t] = np.exp(ys[t]) / np.sum(np.exp(ys[t]))
-    ## softmax (cross-entropy loss)
-    loss += -np.log(ps[t][targets[t], 0])
-
-  # backward pass: compute gradients going backwards
-  dWxh, dWhh, dWhy = np.zeros_like(Wxh), np.zeros_like(Whh), np.zeros_like(Why)
-  dbh, dby = np.zeros_like(bh), np.zeros_like(by)
-  dhnext = np.zeros_like(hs[0])
-  for t in reversed(xrange(len(inputs))):
-    ## compute derivative of error w.r.t the output probabilites
-    ## dE/dy[j] = y[j] - t[j]
-    dy = np.copy(ps[t])
-    dy[targets[t]] -= 1 # backprop into y
-    
-    ## output layer doesnot use activation function, so no need to compute the derivative of error with regard to the net input
-    ## of output layer. 
-    ## then, we could directly compute the derivative of error with regard to the weight between hidden layer and output layer.
-    ## dE/dy[j]*dy[j]/dWhy[j,k] = dE/dy[j] * h[k]
-    dWhy += np.dot(dy, hs[t].T)
-    dby += dy
-    
-    ## backprop into h
-    ## derivative of error with regard to the output of hidden layer
-    ## derivative of H, come from output layer y and also come from H(t+1), the next time H
-    dh = np.dot(Why.T, dy) + dhnext
-    ## backprop through tanh nonlinearity
-    ## derivative of error with regard to the input of hidden layer
-    ## dtanh(x)/dx = 1 - tanh(x) * tanh(x)
-    dhraw = (1 - hs[t] * hs[t]) * dh
-    dbh += dhraw
-    
-    ## derivative of the error with regard to the weight between input layer and hidden layer
-    dWxh += np.dot(dhraw, xs[t].T)
-    dWhh += np.dot(dhraw, hs[t-1].T)
-    ## derivative of the error with regard to H(t+1)
-    ## or derivative of the error of H(t-1) with regard to H(t)
-    dhnext = np.dot(Whh.T, dhraw)
-
-  for dparam in [dWxh, dWhh, dWhy, dbh, dby]:
-    np.clip(dparam, -5, 5, out=dparam) # clip to mitigate exploding gradients
-
-  return loss, dWxh, dWhh, dWhy, dbh, dby, hs[len(inputs)-1]
-
-## given a hidden RNN state, and a input char id, predict the coming n chars
-def sample(h, seed_ix, n):
-  """ 
-  sample a sequence of integers from the model
-  h is memory state, seed_ix is seed letter for first time step
+  moves the parameters and Adagrad memories of model into shared memory, forks num_workers
+  processes that each run train() on their own slice of the data, and reports the
+  total chars/sec and the mean smooth loss of the workers every report_every seconds.
+  with a CheckpointWriter the shared parameters are snapshotted at every report; the
+  per-worker data pointers are not saved, workers restart their slices on resume.
+  state is the loop state returned by load_checkpoint; snapshots count on from its iteration,
+  so they sort after the one resumed from.
+  workers are forked, so this needs a platform with fork (Linux, macOS).
   """
+  blocks = []
+  for name, arr in model.arrays():
+    shm, shared_arr = to_shared(arr)
+    blocks.append(shm)
+    ## the model reads and updates the shared copy from here on
+    setattr(model, name, shared_arr)
+  ## one (chars processed, smooth loss) row per worker
+  stats_shm, stats = to_shared(np.zeros((num_workers, 2)))
+  blocks.append(stats_shm)
 
-  ## a one-hot vector
-  x = np.zeros((vocab_size, 1))
-  x[seed_ix] = 1
+  slice_size = data_size // num_workers
+  ctx = multiprocessing.get_context('fork')
+  workers = []
+  for w in range(num_workers):
+    worker_streams = make_streams(data[w * slice_size : (w + 1) * slice_size], batch_size)
+    proc = ctx.Process(target=hogwild_worker, args=(model, worker_streams, stats, w), daemon=True)
+    proc.start()
+    workers.append(proc)
 
-  ixes = []
-  for t in xrange(n):
-    ## self.h = np.tanh(np.dot(self.W_hh, self.h) + np.dot(self.W_xh, x))
-    h = np.tanh(np.dot(Wxh, x) + np.dot(Whh, h) + bh)
-    ## y = np.dot(self.W_hy, self.h)
-    y = np.dot(Why, h) + by
-    ## softmax
-    p = np.exp(y) / np.sum(np.exp(y))
-    ## sample according to probability distribution
-    ix = np.random.choice(range(vocab_size), p=p.ravel())
+  try:
+    start, last_time, last_chars = time.time(), time.time(), 0.0
+    while True:
+      time.sleep(report_every)
+      now, chars = time.time(), stats[:, 0].sum()
+      sample_ix = model.sample(model.init_hidden(), data[0], 200)[0]
+      txt = ''.join(ix_to_char[ix] for ix in sample_ix)
+      print('---- sample -----')
+      print('----\n %s \n----' % (txt, ))
+      print('%d workers, %ds, chars %d, %.0f chars/sec, loss: %f' % (
+          num_workers, now - start, chars, (chars - last_chars) / (now - last_time), stats[:, 1].mean()))
+      last_time, last_chars = now, chars
+      if writer is not None:
+        n = int(chars) // (seq_length * batch_size) + (state['n'] if state is not None else 0)
+        writer.save(snapshot(model, n, 0, model.init_hidden(batch_size), stats[:, 1].mean()))
+  finally:
+    for proc in workers:
+      proc.terminate()
+      proc.join()
+    ## copy the trained parameters out before the shared blocks go away
+    for name, arr in model.arrays():
+      setattr(model, name, arr.copy())
+    del arr, shared_arr, stats
+    for shm in blocks:
+      shm.close()
+      shm.unlink()
 
-    ## update input x
-    ## use the new sampled result as last input, then predict next char again.
-    x = np.zeros((vocab_size, 1))
-    x[ix] = 1
+## throughput benchmark: fixed number of iterations on a synthetic corpus, timed phase by phase
+def benchmark(hidden_sizes, seq_lengths, vocab_sizes, iters=200, sample_every=100, sample_length=200):
+  """
+  runs iters training iterations (batch_size streams) for every combination of the given
+  hidden sizes, sequence lengths and vocabulary sizes, on uniformly random characters.
+  returns one dict per configuration with chars/sec and the seconds spent in each phase:
+  forward, backward, clip, update and sample. sample is timed after the iterations, as the
+  iters // sample_every draws of sample_length chars the training loop would make (at least one).
+  """
+  rng = np.random.RandomState(0)
+  results = []
+  for hidden_size, seq_length, vocab_size in itertools.product(hidden_sizes, seq_lengths, vocab_sizes):
+    model = CharRNN(vocab_size, hidden_size, learning_rate, dtype, loss_dtype, rng)
+    ## long enough that the streams never wrap around, plus one warm-up iteration
+    corpus = rng.randint(0, vocab_size, size=batch_size * ((iters + 1) * seq_length + 1))
+    streams = make_streams(corpus, batch_size)
+    hprev = model.init_hidden(batch_size)
+    phases = dict.fromkeys(['forward', 'backward', 'clip', 'update', 'sample'], 0.0)
 
-    ixes.append(ix)
+    for n in range(iters + 1):
+      window = streams[:, n * seq_length : (n + 1) * seq_length + 1].T
+      inputs, targets = window[:-1], window[1:]
+      t0 = time.perf_counter()
+      loss, hs, ps = model.forward(inputs, targets, hprev)
+      t1 = time.perf_counter()
+      grads = model.backward(inputs, targets, hs, ps)
+      t2 = time.perf_counter()
+      model.clip(grads)
+      t3 = time.perf_counter()
+      model.step(grads)
+      t4 = time.perf_counter()
+      hprev = hs[-1].T.copy()
+      if n == 0:
+        continue # warm-up, not timed
+      for name, seconds in zip(['forward', 'backward', 'clip', 'update'], [t1 - t0, t2 - t1, t3 - t2, t4 - t3]):
+        phases[name] += seconds
 
-  return ixes
+    ## the first draw is a warm-up, not timed
+    sample_draws = max(1, iters // sample_every)
+    for n in range(sample_draws + 1):
+      t0 = time.perf_counter()
+      model.sample(hprev[:, :1], inputs[0, 0], sample_length)
+      if n > 0:
+        phases['sample'] += time.perf_counter() - t0
+
+    total = sum(phases.values())
+    results.append(dict(hidden_size=hidden_size, seq_length=seq_length, vocab_size=vocab_size,
+                        batch_size=batch_size, dtype=np.dtype(dtype).name, iters=iters, sample_draws=sample_draws, seconds=total,
+                        chars_per_sec=iters * seq_length * batch_size / total, phases=phases))
+  return results
 
 # Prem: The code starts here
-## iterator counter
-n = 0
-## data pointer
-p = 0
-
-mWxh, mWhh, mWhy = np.zeros_like(Wxh), np.zeros_like(Whh), np.zeros_like(Why)
-mbh, mby = np.zeros_like(bh), np.zeros_like(by) # memory variables for Adagrad
-smooth_loss = -np.log(1.0/vocab_size)*seq_length # loss at iteration 0
-
-## main loop
-while True:
-  # prepare inputs (we're sweeping from left to right in steps seq_length long)
-  if p + seq_length + 1 >= len(data) or n == 0:
-    # reset RNN memory
-    ## hprev is the hiddden state of RNN
-    hprev = np.zeros((hidden_size, 1))
-    # go from start of data
-    p = 0
-
-  inputs = [char_to_ix[ch] for ch in data[p : p + seq_length]]
-  targets = [char_to_ix[ch] for ch in data[p + 1 : p + seq_length + 1]]
-
-  # sample from the model now and then
-  if n % 100 == 0:
-    sample_ix = sample(hprev, inputs[0], 200)
-    txt = ''.join(ix_to_char[ix] for ix in sample_ix)
-    print '---- sample -----'
-    print '----\n %s \n----' % (txt, )
-
-  # forward seq_length characters through the net and fetch gradient
-  loss, dWxh, dWhh, dWhy, dbh, dby, hprev = lossFun(inputs, targets, hprev)
-  ## author using Adagrad(a kind of gradient descent)
-  smooth_loss = smooth_loss * 0.999 + loss * 0.001
-  if n % 100 == 0:
-    print 'iter %d, loss: %f' % (n, smooth_loss) # print progress
-  
-  # perform parameter update with Adagrad
-  ## parameter update for Adagrad is different from gradient descent parameter update
-  ## need to learn what is Adagrad exactly is.
-  ## seems using weight matrix, derivative of weight matrix and a memory matrix, update memory matrix each iteration
-  ## memory is the accumulation of each squared derivatives in each iteration.
-  ## mem += dparam * dparam
-  for param, dparam, mem in zip([Wxh, Whh, Why, bh, by],
-                                [dWxh, dWhh, dWhy, dbh, dby],
-                                [mWxh, mWhh, mWhy, mbh, mby]):
-    mem += dparam * dparam
-    ## learning_rate is adjusted by mem, if mem is getting bigger, then learning_rate will be small
-    ## gradient descent of Adagrad
-    param += -learning_rate * dparam / np.sqrt(mem + 1e-8) # adagrad update
-
-  p += seq_length # move data pointer
-  n += 1 # iteration counter 
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Train a character-level vanilla RNN on %s.' % corpus_path)
+  parser.add_argument('--resume', action='store_true', help='continue from the latest snapshot in --checkpoint-dir')
+  parser.add_argument('--checkpoint-dir', default=checkpoint_dir, help='where snapshots are written and read')
+  parser.add_argument('--benchmark', action='store_true', help='time the training phases on a synthetic corpus instead of training')
+  parser.add_argument('--hidden-sizes', type=int, nargs='+', default=[hidden_size], help='benchmark grid: hidden sizes')
+  parser.add_argument('--seq-lengths', type=int, nargs='+', default=[seq_length], help='benchmark grid: unroll lengths')
+  parser.add_argument('--vocab-sizes', type=int, nargs='+', default=[vocab_size], help='benchmark grid: vocabulary sizes')
+  parser.add_argument('--iters', type=int, default=200, help='benchmark iterations per configuration')
+  parser.add_argument('--sample-every', type=int, default=100, help='benchmark: iterations per 200-char sample, timed as in training')
+  parser.add_argument('--benchmark-out', default='benchmark.json', help='where the benchmark results are written as JSON')
+  args = parser.parse_args()
+  if args.sample_every < 1:
+    parser.error('--sample-every must be at least 1')
+
+  if args.benchmark:
+    results = benchmark(args.hidden_sizes, args.seq_lengths, args.vocab_sizes, args.iters, args.sample_every)
+    for r in results:
+      print('hidden %d, seq %d, vocab %d: %.0f chars/sec (%s)' % (
+          r['hidden_size'], r['seq_length'], r['vocab_size'], r['chars_per_sec'],
+          ', '.join('%s %.3fs' % item for item in r['phases'].items())))
+    with open(args.benchmark_out, 'w') as f:
+      json.dump(results, f, indent=2)
+    raise SystemExit(0)
+
+  state = None
+  if args.resume:
+    path = latest_checkpoint(args.checkpoint_dir)
+    if path is None:
+      print('no snapshot in %s, starting from scratch' % args.checkpoint_dir)
+    else:
+      state = load_checkpoint(model, path)
+      print('resuming from %s at iter %d' % (path, state['n']))
+
+  writer = CheckpointWriter(args.checkpoint_dir)
+  try:
+    if num_workers > 1:
+      hogwild(model, num_workers, writer, state)
+    else:
+      train(model, make_streams(data, batch_size), state=state, writer=writer)
+  finally:
+    writer.close()
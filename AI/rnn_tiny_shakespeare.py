@@ -7,6 +7,10 @@ def move_txt():
     source_dir = '/kaggle/input/tinyshakespeare'
     destination_dir = '/kaggle/working/'
 
+    # Outside Kaggle, tinyshakespeare.txt is expected in the working directory.
+    if not os.path.isdir(source_dir):
+        return
+
     # Ensure the destination directory exists
     os.makedirs(destination_dir, exist_ok=True)
 
@@ -30,47 +34,246 @@ def move_txt():
 # Execute the function
 move_txt()
 
+import argparse
+import ast
+import collections
+import glob
+import hashlib
+import io
+import itertools
+import json
+import math
+import queue
+import resource
+import sys
+import threading
+import time
+import warnings
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
+from torch.profiler import ProfilerActivity, record_function
 import numpy as np
 
 # Check device
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-print("Using device:", device)
 
 # Hyperparameters
 batch_size   = 64 #the number of parallel computations over which gradients will be computed.
+eval_batch_size = 256 # Streams per validation batch. No gradients are kept, so it can be much larger than batch_size.
 seq_length   = 100 #The length of the input layer.
 hidden_size  = 256 # No. of hidden units in the hidden layer of the LSTM. 
 num_layers   = 2 # How many stacked LSTM layers are there.
 num_epochs   = 20
+steps_per_epoch = 0 # > 0: end each epoch after this many steps, for short runs such as sweeps.
 learning_rate = 0.002
+bf16_autocast = False # Run the forward passes under torch.autocast with bfloat16 (optimizer state and loss stay fp32). Fast on CPUs with AMX/AVX512-BF16.
+compile_model = False # torch.compile the model: one graph for training/validation and one specialized for single-token generation.
+quantize_int8 = False # After training, export a dynamically int8-quantized copy (LSTM and Linear layers) to int8_path and compare it with fp32 on the CPU.
+int8_path    = "char_rnn_int8.pt"
+stream_from_disk = False # Leave the encoded corpus memory-mapped and read every batch from it in the prefetch thread, for corpora larger than memory.
+corpus_chunk_chars = 1 << 24 # Characters read and encoded at a time when the corpus is first encoded.
+prefetch     = False # Keep the token streams in host memory and copy batches to the device from a background thread (for data that doesn't fit on the device).
+ddp_procs    = 1 # > 1: train with DistributedDataParallel on this many CPU processes (gloo); each takes batch_size // ddp_procs of the streams.
+checkpoint_dir = "checkpoints" # Checkpoints are written here at the end of every epoch and every checkpoint_every steps; None disables them.
+checkpoint_every = 500 # Steps between mid-epoch checkpoints; 0 saves at the end of epochs only.
+keep_checkpoints = 3 # Older checkpoints are deleted.
+# The settings above that --set can override, e.g. --set hidden_size=512 --set learning_rate=1e-3.
+hyperparameters = {name: value for name, value in globals().items()
+                   if name in ('batch_size', 'eval_batch_size', 'seq_length', 'hidden_size', 'num_layers', 'num_epochs',
+                               'steps_per_epoch', 'learning_rate', 'bf16_autocast', 'compile_model', 'quantize_int8',
+                               'int8_path', 'stream_from_disk', 'corpus_chunk_chars', 'prefetch', 'ddp_procs', 'checkpoint_dir', 'checkpoint_every', 'keep_checkpoints')}
+
+parser = argparse.ArgumentParser(description="Train a character-level LSTM on Tiny Shakespeare, or generate text from a checkpoint.")
+parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                    help="override a hyperparameter with a Python literal, e.g. --set hidden_size=512")
+parser.add_argument('--results', metavar='FILE',
+                    help="after training, write the hyperparameters, final losses, tokens/sec and peak memory to FILE as JSON and exit")
+parser.add_argument('--resume', nargs='?', const='latest', default=None, metavar='CHECKPOINT',
+                    help="continue training from CHECKPOINT, or from the newest one in checkpoint_dir, at the batch where it stopped")
+parser.add_argument('--generate', metavar='CHECKPOINT', help="load CHECKPOINT and generate text, without training")
+parser.add_argument('--prompt', action='append', help="prompt for --generate; repeat for several prompts generated together")
+parser.add_argument('--length', type=int, default=300, help="characters to generate per prompt")
+parser.add_argument('--temperature', type=float, default=0.8)
+parser.add_argument('--top-k', type=int, default=0, help="sample from the k most likely characters only (0: all)")
+parser.add_argument('--top-p', type=float, default=1.0, help="sample from the smallest set of characters with this total probability")
+parser.add_argument('--profile', nargs='?', const='profile', default=None, metavar='DIR',
+                    help="profile a window of training steps with torch.profiler; traces and tables go to DIR")
+parser.add_argument('--profile-start', type=int, default=20, help="training steps to run before the profiled window")
+parser.add_argument('--profile-steps', type=int, default=10, help="training steps in the profiled window")
+parser.add_argument('--serve', metavar='CHECKPOINT', help="load CHECKPOINT and serve POST /generate and GET /metrics on localhost")
+parser.add_argument('--port', type=int, default=8000)
+parser.add_argument('--batch-window', type=float, default=10.0, help="ms to wait for more requests to decode together with the first one")
+parser.add_argument('--max-batch', type=int, default=32, help="most requests decoded together")
+args = parser.parse_args()
+inference_checkpoint = args.generate or args.serve # Set when this run only generates from a checkpoint.
+for assignment in args.set:
+    name, _, value = assignment.partition('=')
+    if name not in hyperparameters:
+        parser.error(f"--set {assignment}: unknown hyperparameter, choose from {', '.join(hyperparameters)}")
+    try:
+        hyperparameters[name] = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        hyperparameters[name] = value # a bare string such as a path
+globals().update(hyperparameters)
+
+
+# ------------------------------
+# 0. Data-parallel launch
+# ------------------------------
+# torchrun sets RANK and WORLD_SIZE. Without them and with ddp_procs > 1, the script relaunches itself
+# under torchrun on this host; `torchrun --standalone --nproc_per_node=N rnn_tiny_shakespeare.py` works too.
+if ddp_procs > 1 and 'RANK' not in os.environ and not inference_checkpoint:
+    # Split the cores between the ranks instead of letting each one start a thread per core.
+    os.environ.setdefault('OMP_NUM_THREADS', str(max(1, (os.cpu_count() or 1) // ddp_procs)))
+    from torch.distributed.run import main as torchrun
+    torchrun(['--standalone', f'--nproc_per_node={ddp_procs}', sys.argv[0], *sys.argv[1:]])
+    sys.exit()
+
+distributed = 'RANK' in os.environ
+rank = int(os.environ.get('RANK', 0))
+world_size = int(os.environ.get('WORLD_SIZE', 1))
+is_main = rank == 0
+log = print if is_main else (lambda *args, **kwargs: None) # Only rank 0 prints.
+if distributed:
+    if batch_size % world_size or eval_batch_size % world_size:
+        raise ValueError(f"batch_size {batch_size} and eval_batch_size {eval_batch_size} must be divisible by {world_size} processes")
+    dist.init_process_group('gloo')
+    device = torch.device('cpu') # gloo reduces CPU tensors.
+local_batch_size = batch_size // world_size # Streams trained by this process; together the ranks train batch_size.
+log("Using device:", device, f"x {world_size} processes" if distributed else "")
+
+
+def mean_over_ranks(value):
+    """The average of a float over all ranks; every rank has to call this. Without DDP, the value itself."""
+    if not distributed:
+        return value
+    total = torch.tensor([value], dtype=torch.float64)
+    dist.all_reduce(total)
+    return total.item() / world_size
 
 
 # ------------------------------
 # 1. Load and preprocess the data
 # ------------------------------
-with open('tinyshakespeare.txt', 'r') as f:
-    text = f.read()
+def read_chunks(path, chunk_chars):
+    """The text of a UTF-8 file, chunk_chars characters at a time, with newlines translated as in text mode."""
+    # The text layer decodes incrementally, so neither a multi-byte character nor a \r\n is split between chunks.
+    with open(path, 'r', encoding='utf-8') as f:
+        while chunk := f.read(chunk_chars):
+            yield chunk
+
+
+def codepoints(chunk):
+    """The characters of a str as an array of their codepoints: uint8 for ASCII, otherwise uint32."""
+    if chunk.isascii():
+        return np.frombuffer(chunk.encode('ascii'), dtype=np.uint8)
+    # UTF-32 gives one fixed-width codepoint per character.
+    return np.frombuffer(chunk.encode('utf-32-le'), dtype='<u4')
+
+
+def encode_corpus(path, npy_path, chunk_chars=corpus_chunk_chars):
+    """
+    Encode a UTF-8 text file as vocabulary indices into the .npy file npy_path without a Python loop over characters,
+    reading chunk_chars characters at a time so that neither the text nor its encoding has to fit in memory.
+    The first pass finds the vocabulary and the length, the second writes data[i] == chars.index(text[i]) as uint8
+    (uint16 if there are more than 256 distinct characters). Returns chars, the sorted vocabulary.
+    """
+    counts = np.zeros(1, dtype=np.int64)
+    for chunk in read_chunks(path, chunk_chars):
+        chunk_counts = np.bincount(codepoints(chunk))
+        if len(chunk_counts) > len(counts):
+            counts = np.pad(counts, (0, len(chunk_counts) - len(counts)))
+        counts[:len(chunk_counts)] += chunk_counts
+    # The codepoints that occur, in sorted order, are the vocabulary (same order as sorted(set(text))).
+    present = np.flatnonzero(counts)
+    dtype = np.uint8 if len(present) <= 256 else np.uint16
+    lookup = np.zeros(len(counts), dtype=dtype)
+    lookup[present] = np.arange(len(present))
+
+    data = np.lib.format.open_memmap(npy_path, mode='w+', dtype=dtype, shape=(int(counts.sum()),))
+    pos = 0
+    for chunk in read_chunks(path, chunk_chars):
+        encoded = lookup[codepoints(chunk)]
+        data[pos:pos + len(encoded)] = encoded
+        pos += len(encoded)
+    data.flush()
+    del data
+    return [chr(c) for c in present]
+
+
+def load_corpus(path):
+    """
+    Load the encoded corpus from a cache next to the text file, keyed by the hash of its contents.
+    The first run encodes the text and writes <name>.<hash>.npy and <name>.<hash>.vocab.json;
+    later runs memory-map the .npy, which takes milliseconds, and reads only the pages they use.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    base = f"{os.path.splitext(path)[0]}.{digest.hexdigest()[:16]}"
+    npy_path, vocab_path = base + '.npy', base + '.vocab.json'
+
+    if not (os.path.exists(npy_path) and os.path.exists(vocab_path)):
+        # The .npy is renamed into place last, so an interrupted encoding is redone rather than used.
+        chars = encode_corpus(path, npy_path + '.tmp')
+        with open(vocab_path, 'w', encoding='utf-8') as f:
+            json.dump(chars, f, ensure_ascii=False)
+        os.replace(npy_path + '.tmp', npy_path)
+
+    data = np.load(npy_path, mmap_mode='r')
+    with open(vocab_path, 'r', encoding='utf-8') as f:
+        chars = json.load(f)
+    return data, chars
+
+
+def load_checkpoint(path):
+    """A checkpoint written by save_checkpoint, on the CPU; 'latest' is the newest one in checkpoint_dir."""
+    if path == 'latest':
+        paths = sorted(glob.glob(os.path.join(checkpoint_dir, 'ckpt_*.pt')))
+        if not paths:
+            raise FileNotFoundError(f"no checkpoints in {checkpoint_dir}")
+        path = paths[-1]
+    log(f"Loading checkpoint {path}")
+    return torch.load(path, map_location='cpu', weights_only=True)
+
+
+checkpoint = load_checkpoint(inference_checkpoint or args.resume) if inference_checkpoint or args.resume else None
+
+if inference_checkpoint:
+    # Generation only: the vocabulary and layer sizes come from the checkpoint, no corpus is read.
+    chars = checkpoint['chars']
+    hidden_size, num_layers = checkpoint['hidden_size'], checkpoint['num_layers']
+else:
+    # data holds one small integer per character; make_stream converts it to int64 for the model.
+    # Under DDP rank 0 writes the cache first, so the other ranks don't race it to the same files.
+    if distributed and not is_main:
+        dist.barrier()
+    data, chars = load_corpus('tinyshakespeare.txt')
+    if distributed and is_main:
+        dist.barrier()
+    if checkpoint is not None and checkpoint['chars'] != chars:
+        raise ValueError("the checkpoint was trained on a different vocabulary than this corpus")
 
 # Build character-level vocabulary
-chars = sorted(list(set(text)))
 vocab_size = len(chars) # The total number of characters the model plays with.
-print(f"Vocabulary size: {vocab_size}")
+log(f"Vocabulary size: {vocab_size}")
 
 # Mappings from characters to integers and vice versa
 stoi = {ch: i for i, ch in enumerate(chars)}
 itos = {i: ch for i, ch in enumerate(chars)}
 
-# Encode entire text into a numpy array of integers
-data = np.array([stoi[c] for c in text], dtype=np.int64)
-
 # Split data: 90% training, 10% validation
-split_idx = int(0.9 * len(data))
-train_data = data[:split_idx]
-val_data = data[split_idx:]
-print(f"Train data length: {len(train_data)}, Val data length: {len(val_data)}")
+if not inference_checkpoint:
+    split_idx = int(0.9 * len(data))
+    train_data = data[:split_idx]
+    val_data = data[split_idx:]
+    log(f"Train data length: {len(train_data)}, Val data length: {len(val_data)}")
 
 
 
@@ -80,33 +283,107 @@ print(f"Train data length: {len(train_data)}, Val data length: {len(val_data)}")
 
 
 """
-Summary of following function: data is a single row of integers to be trained on.
+Summary of following functions: data is a single row of integers to be trained on.
 batch_size is the number of parallel processors. seq_length is the context of the LLM.
 num_batch is the total number of runs till you exhaust all the data.
-You reshape data to contain batch_size no. of rows and num_batch * seq_length no of columns. Any extra elements are deleted.
+make_stream reshapes data to contain batch_size no. of rows and num_batch * seq_length + 1 no of columns. Any extra elements are deleted.
+The extra column is the first token of the next row, so that the last input of each row has a target too.
+This is done once, and the result is converted to a tensor on the device once.
 Each call of get_batch then gives you, a 2D array of input, a x, y = batch_size x seq_length matrix, where y is one unit shifted version of x.
+x and y are views into the stream, so no data is copied per batch.
 """
 
 
-def get_batch(data, batch_size, seq_length): 
+def make_stream(data, batch_size, seq_length, on_device=True, rank=0, world_size=1, from_disk=False):
     # data = train_data, for example
     # Calculate how many full batches we can make
-    num_batches = len(data) // (batch_size * seq_length)
+    # The - 1 keeps one token for the target of the very last input.
+    num_batches = (len(data) - 1) // (batch_size * seq_length)
     # Trim data so that it divides evenly into batches
 
     # num_batches has just been calculated. We are ignoring any part of the data that cannot fit into nice chunks of bacth_sizes * seq_length.
     # This ensures that there is only as much content in the data that can be trained parallely in each round.
-    data = data[:num_batches * batch_size * seq_length] 
-    
-    # Reshape into (batch_size, -1) so that each row is a continuous stream of tokens
-    # batch_size rows and remaining columns. Each column has num_batches * seq_length data. See: https://colab.research.google.com/drive/1oWYpDtPvKWImUXzPz4vyMpxXdEbOe98D?usp=sharing
-    data = data.reshape((batch_size, -1))
-    
-    # Yield batches sequentially
-    for i in range(0, data.shape[1] - seq_length, seq_length): # data.shape[1] = seq_length * num_batches. This give [0, seq_length, 2 seq_length,..., seq_length * (num_batches - 1) ]
-        x = data[:, i:i+seq_length]
-        y = data[:, i+1:i+seq_length+1]  # targets are shifted by one
-        yield torch.tensor(x, dtype=torch.long).to(device), torch.tensor(y, dtype=torch.long).to(device)
+    row_length = num_batches * seq_length
+
+    # Reshape into (batch_size, row_length + 1) so that each row is a continuous stream of tokens
+    # batch_size rows and remaining columns. Each row has num_batches * seq_length data, plus the first token of the next row. See: https://colab.research.google.com/drive/1oWYpDtPvKWImUXzPz4vyMpxXdEbOe98D?usp=sharing
+    # Under DDP each rank keeps its own block of batch_size // world_size rows, so the ranks train disjoint streams.
+    rows = batch_size // world_size
+    if from_disk:
+        # The same rows as a strided view of the memory-mapped corpus: nothing is read until get_batch slices it.
+        return np.lib.stride_tricks.as_strided(data[rank * rows * row_length:], shape=(rows, row_length + 1),
+                                               strides=(row_length * data.itemsize, data.itemsize), writeable=False)
+    starts = (rank * rows + np.arange(rows)) * row_length
+    data = data[starts[:, None] + np.arange(row_length + 1)]
+
+    if not on_device:
+        # Stays in host memory with the compact dtype; prefetch_batches moves each batch to the device.
+        stream = torch.from_numpy(data)
+        return stream.pin_memory() if device.type == 'cuda' else stream
+    # The gather above copies in the compact dtype; then one int64 copy (torch.from_numpy shares its memory) and one transfer to the device.
+    return torch.from_numpy(data.astype(np.int64)).to(device)
+
+
+def get_batch(stream, seq_length, first_step=0):
+    # Yield batches sequentially, starting with batch number first_step (to resume in the middle of an epoch)
+    for i in range(first_step * seq_length, stream.shape[1] - 1, seq_length): # stream.shape[1] = seq_length * num_batches + 1. This give [0, seq_length, 2 seq_length,..., seq_length * (num_batches - 1) ]
+        x = stream[:, i:i+seq_length]
+        y = stream[:, i+1:i+seq_length+1]  # targets are shifted by one
+        if isinstance(stream, np.ndarray):
+            # A stream made with from_disk: read this batch's window from the file into one small tensor.
+            window = torch.from_numpy(np.ascontiguousarray(stream[:, i:i+seq_length+1]))
+            x, y = window[:, :-1], window[:, 1:]
+        yield x, y
+
+
+def prefetch_batches(stream, seq_length, first_step=0, depth=2):
+    """
+    Same batches as get_batch, for a stream made with on_device=False or from_disk: a background thread
+    reads them and copies them to the device as int64, up to `depth` batches ahead of the training loop.
+    """
+    batches = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def worker():
+        for x, y in get_batch(stream, seq_length, first_step):
+            item = (x.to(device, torch.long, non_blocking=True), y.to(device, torch.long, non_blocking=True))
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if stop.is_set():
+                return
+        batches.put(None)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while (item := batches.get()) is not None:
+            yield item
+    finally:
+        # The consumer may stop early (break); let the thread finish instead of blocking on a full queue.
+        stop.set()
+        thread.join()
+
+
+def batches(stream, seq_length, first_step=0):
+    if prefetch or stream_from_disk:
+        return prefetch_batches(stream, seq_length, first_step)
+    return get_batch(stream, seq_length, first_step)
+
+
+if not inference_checkpoint:
+    on_device = not (prefetch or stream_from_disk)
+    train_stream = make_stream(train_data, batch_size, seq_length, on_device, rank, world_size, from_disk=stream_from_disk)
+    # A short validation split can't fill eval_batch_size streams of one batch each; use as many as it can fill.
+    val_rows = min(eval_batch_size, (len(val_data) - 1) // seq_length) // world_size * world_size
+    if val_rows == 0 or (len(train_data) - 1) // (batch_size * seq_length) == 0:
+        raise ValueError(f"seq_length {seq_length} is too long for one batch: the training split has {len(train_data)} "
+                         f"characters for batch_size {batch_size}, the validation split {len(val_data)} "
+                         f"for {world_size} stream(s)")
+    val_stream = make_stream(val_data, val_rows, seq_length, on_device, rank, world_size, from_disk=stream_from_disk)
 
 
 # ------------------------------
@@ -133,107 +410,692 @@ class CharRNN(nn.Module):
     def forward(self, x, hidden):
         #hidden from the past affects the output!
         # x: (batch, seq_length)
-        x = self.embed(x)  # -> (batch, seq_length, hidden_size)
-        out, hidden = self.lstm(x, hidden)
+        # The record_function labels name the layers in --profile traces; they cost nothing otherwise.
+        with record_function("embedding"):
+            x = self.embed(x)  # -> (batch, seq_length, hidden_size)
+        with record_function("lstm"):
+            out, hidden = self.lstm(x, hidden)
         # out: (batch, seq_length, hidden_size)
-        out = self.fc(out)  # -> (batch, seq_length, vocab_size)
+        with record_function("fc"):
+            out = self.fc(out)  # -> (batch, seq_length, vocab_size)
         return out, hidden
     
     def init_hidden(self, batch_size):
         # Initialize hidden state and cell state with zeros. Zeros is the keyword here.
-        h0 = torch.zeros(self.num_layers, batch_size, self.hidden_size).to(device)
-        c0 = torch.zeros(self.num_layers, batch_size, self.hidden_size).to(device)
+        # On the model's own device, which is the CPU for an int8 model even when training used the GPU.
+        h0 = torch.zeros(self.num_layers, batch_size, self.hidden_size, device=self.embed.weight.device)
+        c0 = torch.zeros(self.num_layers, batch_size, self.hidden_size, device=self.embed.weight.device)
         return (h0, c0)
 
 
 model = CharRNN(vocab_size, hidden_size, num_layers).to(device) # num_layers is the no. of LSTM layers
-optimizer = optim.Adam(model.parameters(), lr=learning_rate)
-criterion = nn.CrossEntropyLoss()
+
+
+def compiled(module, purpose):
+    """
+    torch.compile(module), falling back to running `module` eagerly with a warning if compilation
+    is not available. torch.compile is lazy and fails on the first call, so that call is guarded too.
+    Each call of this function builds its own graph cache, specialized to the shapes it sees.
+    """
+    if not hasattr(torch, 'compile'):
+        warnings.warn(f"torch.compile is not available in torch {torch.__version__}; {purpose} runs eagerly")
+        return module
+    compiled_module = torch.compile(module, dynamic=False)
+    first_call = True
+
+    def forward(*args):
+        nonlocal compiled_module, first_call
+        if first_call:
+            first_call = False
+            try:
+                return compiled_module(*args)
+            except Exception as e:
+                warnings.warn(f"torch.compile failed for {purpose} ({type(e).__name__}: {e}); running eagerly")
+                compiled_module = module
+        return compiled_module(*args)
+
+    return forward
+
+
+# ------------------------------
+# 4. Text Generation
+# ------------------------------
+def per_prompt(value, n, dtype, device):
+    """A per-prompt setting as a length-n tensor: either one value for all prompts or a list of n."""
+    values = value if isinstance(value, (list, tuple)) else [value] * n
+    if len(values) != n:
+        raise ValueError(f"expected one value or {n} values, got {len(values)}")
+    return torch.tensor(values, dtype=dtype, device=device)
+
+
+def sample_next(logits, temperature, top_k, top_p):
+    """
+    Sample one token per row of logits (batch, vocab_size), with each row's own temperature,
+    top_k (0 keeps every token) and top_p (1.0 keeps every token). Everything stays on device.
+    """
+    logits = logits.float() / temperature.unsqueeze(1)
+    sorted_logits, sorted_idx = logits.sort(dim=-1, descending=True)
+    ranks = torch.arange(logits.size(1), device=logits.device).unsqueeze(0)
+    sorted_logits = sorted_logits.masked_fill((top_k.unsqueeze(1) > 0) & (ranks >= top_k.unsqueeze(1)), float('-inf'))
+    probs = torch.softmax(sorted_logits, dim=-1)
+    # Nucleus: drop a token once the more likely tokens before it already cover top_p. The first token always stays.
+    probs = probs.masked_fill(probs.cumsum(dim=-1) - probs > top_p.unsqueeze(1), 0.0)
+    choice = torch.multinomial(probs, num_samples=1)  # multinomial renormalizes
+    return sorted_idx.gather(1, choice)  # (batch, 1)
+
+
+@torch.no_grad()
+def decode_steps(model, prompts, gen_length, temperature=1.0, top_k=0, top_p=1.0, step_forward=None):
+    """
+    Yield the sampled token of every prompt, one step at a time, as a (len(prompts), 1) tensor on the device.
+    Arguments as for generate_batch. All prompts are primed in one packed LSTM pass and decoded together.
+    """
+    step_forward = step_forward or model
+    device = model.embed.weight.device
+    n = len(prompts)
+    temperature = per_prompt(temperature, n, torch.float32, device)
+    top_k = per_prompt(top_k, n, torch.long, device)
+    top_p = per_prompt(top_p, n, torch.float32, device)
+    model.eval()
+
+    lengths = torch.tensor([len(p) for p in prompts])
+    if (lengths == 0).any():
+        raise ValueError("prompts must not be empty")
+    padded = torch.zeros(n, int(lengths.max()), dtype=torch.long)
+    for i, p in enumerate(prompts):
+        padded[i, :len(p)] = torch.tensor([stoi[c] for c in p])
+    padded = padded.to(device)
+
+    # Prime: the packed sequence makes the LSTM stop at each prompt's own length, so the
+    # final hidden state belongs to the last real character and not to the padding.
+    packed = nn.utils.rnn.pack_padded_sequence(model.embed(padded), lengths, batch_first=True, enforce_sorted=False)
+    out, hidden = model.lstm(packed, model.init_hidden(n))
+    out, _ = nn.utils.rnn.pad_packed_sequence(out, batch_first=True)
+    last = out[torch.arange(n, device=device), lengths.to(device) - 1]
+    logits = model.fc(last)
+    for i in range(gen_length):
+        next_idx = sample_next(logits, temperature, top_k, top_p)
+        yield next_idx
+        if i + 1 < gen_length:
+            outputs, hidden = step_forward(next_idx, hidden)
+            logits = outputs[:, -1, :]
+
+
+def generate_batch(model, prompts, gen_length=200, temperature=1.0, top_k=0, top_p=1.0, step_forward=None):
+    """
+    Generate a continuation for every prompt in `prompts` at once.
+    - temperature, top_k, top_p: one value for every prompt, or a list with one value per prompt.
+      Lower temperature -> more deterministic; top_k=0 and top_p=1.0 disable those filters.
+    - step_forward: runs the model on one token per stream (e.g. a compiled graph); defaults to model.
+    The sampled tokens stay on the device until the end, so there is no host sync per token.
+    """
+    generated = torch.empty(len(prompts), gen_length, dtype=torch.long, device=model.embed.weight.device)
+    for i, next_idx in enumerate(decode_steps(model, prompts, gen_length, temperature, top_k, top_p, step_forward)):
+        generated[:, i:i + 1] = next_idx
+    return [p + ''.join(itos[j] for j in row) for p, row in zip(prompts, generated.tolist())]
+
+
+def generate_text(model, start_str, gen_length=200, temperature=1.0, step_forward=None):
+    """
+    Generate text given a starting string.
+    - model: a CharRNN, or the path of an int8 export (see export_int8), which is loaded on the CPU.
+    - temperature: controls randomness. Lower -> more deterministic.
+    - step_forward: runs the model on one token at a time (e.g. a compiled graph); defaults to model.
+    """
+    if isinstance(model, str):
+        model = load_int8(model)
+    return generate_batch(model, [start_str], gen_length, temperature, step_forward=step_forward)[0]
+
+
+def quantize_dynamic_int8(model):
+    """The nn.LSTM and nn.Linear layers of a CPU CharRNN with int8 weights; activations are quantized on the fly."""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # torch.ao.quantization deprecation notices
+        return torch.ao.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+
+def export_int8(model, path):
+    """Save a dynamically int8-quantized copy of `model` to `path`, with what load_int8 needs to rebuild it."""
+    fp32_cpu = CharRNN(vocab_size, model.hidden_size, model.num_layers)
+    fp32_cpu.load_state_dict(model.state_dict())
+    quantized = quantize_dynamic_int8(fp32_cpu.eval())
+    torch.save({'state_dict': quantized.state_dict(), 'chars': chars,
+                'hidden_size': model.hidden_size, 'num_layers': model.num_layers}, path)
+    return quantized
+
+
+def load_int8(path):
+    """Load a model saved by export_int8. It runs on the CPU only."""
+    # The packed int8 weights are not plain tensors, so weights_only loading can't read them. Only load files you made.
+    saved = torch.load(path, map_location='cpu', weights_only=False)
+    if saved['chars'] != chars:
+        raise ValueError(f"{path} was exported with a different vocabulary than this corpus")
+    quantized = quantize_dynamic_int8(CharRNN(len(saved['chars']), saved['hidden_size'], saved['num_layers']).eval())
+    quantized.load_state_dict(saved['state_dict'])
+    return quantized
+
+
+def state_dict_bytes(model):
+    """Serialized size of the model's weights, as a measure of its memory footprint."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+# Forward specialized for generation: one token per stream per call.
+generate_forward = compiled(model, "generation") if compile_model else model
+
+class GenerationFailed(Exception):
+    """Put on a request's queue by BatchingGenerator in place of its remaining characters when decoding fails."""
+
+
+class BatchingGenerator:
+    """
+    Runs generation requests on a background thread. Requests that arrive within `window` seconds of the
+    first waiting one (up to max_batch of them) are decoded together, and every request's characters go to
+    its own queue as soon as they are sampled. One host sync per step serves the whole batch.
+    """
+    def __init__(self, model, window=0.01, max_batch=32, step_forward=None):
+        self.model = model
+        self.window = window
+        self.max_batch = max_batch
+        self.step_forward = step_forward
+        self.requests = queue.Queue()
+        self.lock = threading.Lock() # guards the metrics below
+        self.started = time.perf_counter()
+        self.busy_seconds = 0.0
+        self.counts = collections.Counter()
+        self.first_token_latency = collections.deque(maxlen=1000) # seconds, most recent requests
+        self.latency = collections.deque(maxlen=1000)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, prompt, length, temperature=1.0, top_k=0, top_p=1.0):
+        """
+        Queue a request. Returns a queue that yields its characters one at a time, then None,
+        or a GenerationFailed instead of the rest if the batch it was decoded in failed.
+        """
+        out = queue.Queue()
+        self.requests.put((prompt, length, temperature, top_k, top_p, out, time.perf_counter()))
+        return out
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.perf_counter() + self.window
+            while len(batch) < self.max_batch and (timeout := deadline - time.perf_counter()) > 0:
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._decode(batch)
+
+    def _decode(self, batch):
+        prompts, lengths, temperatures, top_ks, top_ps, outs, arrived = zip(*batch)
+        start = time.perf_counter()
+        i = -1
+        try:
+            steps = decode_steps(self.model, list(prompts), max(lengths), list(temperatures), list(top_ks), list(top_ps),
+                                 self.step_forward)
+            for i, next_idx in enumerate(steps):
+                # Requests shorter than the longest one in the batch are finished early; the rest keep decoding.
+                for out, ix, length, t0 in zip(outs, next_idx.view(-1).tolist(), lengths, arrived):
+                    if i < length:
+                        out.put(itos[ix])
+                    if i == 0:
+                        self.first_token_latency.append(time.perf_counter() - t0)
+                    if i + 1 == length:
+                        out.put(None)
+                        self.latency.append(time.perf_counter() - t0)
+        except Exception as e:
+            # Keep serving; the unfinished requests of this batch are told that their generation failed.
+            print(f"Generation failed: {type(e).__name__}: {e}")
+            for out, length in zip(outs, lengths):
+                if i + 1 < length:
+                    out.put(GenerationFailed(f"{type(e).__name__}: {e}"))
+            with self.lock:
+                self.counts['errors'] += len(batch)
+            return
+        with self.lock:
+            self.busy_seconds += time.perf_counter() - start
+            self.counts['requests'] += len(batch)
+            self.counts['batches'] += 1
+            self.counts['tokens'] += sum(lengths)
+
+    def metrics(self):
+        """Counts since start, tokens/sec and latency percentiles (ms) over the last 1000 requests."""
+        def percentiles(seconds):
+            seconds = sorted(seconds)
+            return {f'p{q}': round(1000 * seconds[min(len(seconds) - 1, len(seconds) * q // 100)], 1)
+                    for q in (50, 95, 99)} if seconds else {}
+        with self.lock:
+            counts, busy = dict(self.counts), self.busy_seconds
+        return {**counts,
+                'mean_batch_size': counts.get('requests', 0) / max(1, counts.get('batches', 0)),
+                'tokens_per_sec': counts.get('tokens', 0) / (time.perf_counter() - self.started),
+                'tokens_per_busy_sec': counts.get('tokens', 0) / busy if busy else 0.0,
+                'queued': self.requests.qsize(),
+                'first_token_latency_ms': percentiles(self.first_token_latency),
+                'latency_ms': percentiles(self.latency)}
+
+
+def serve(generator, port, max_length=2000):
+    """
+    Serve on 127.0.0.1:port until interrupted.
+    POST /generate with JSON {"prompt", "length", "temperature", "top_k", "top_p", "stream"} returns the generated
+    characters (without the prompt): with "stream" true as a chunked text/plain body while they are sampled,
+    otherwise as JSON {"text"} at the end.
+    If generation fails, the response is a 500, or a streamed body cut off before its last chunk.
+    GET /metrics returns generator.metrics() as JSON.
+    """
+    def characters(out):
+        """The characters on a request's queue as they arrive; raises GenerationFailed if decoding failed."""
+        while (ch := out.get()) is not None:
+            if isinstance(ch, GenerationFailed):
+                raise ch
+            yield ch
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1' # keep-alive, and chunked streaming responses
+
+        def send_json(self, status, obj):
+            body = json.dumps(obj).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self.send_json(200, generator.metrics())
+            else:
+                self.send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/generate':
+                return self.send_json(404, {'error': 'not found'})
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                prompt, length = request['prompt'], int(request.get('length', 200))
+                temperature, top_k = float(request.get('temperature', 1.0)), int(request.get('top_k', 0))
+                top_p = float(request.get('top_p', 1.0))
+                if not prompt or any(c not in stoi for c in prompt):
+                    raise ValueError("prompt must be non-empty and use only characters from the training text")
+                # Checked here: one bad request would otherwise fail the whole batch it is decoded with.
+                if not 0 < length <= max_length or not (math.isfinite(temperature) and temperature > 0):
+                    raise ValueError(f"length must be in 1..{max_length} and temperature positive")
+                if top_k < 0 or not 0 < top_p <= 1:
+                    raise ValueError("top_k must be 0 (off) or more, and top_p in (0, 1]")
+            except (KeyError, TypeError, ValueError) as e:
+                return self.send_json(400, {'error': str(e)})
+            chars = characters(generator.submit(prompt, length, temperature, top_k, top_p))
+            try:
+                if not request.get('stream'):
+                    return self.send_json(200, {'text': ''.join(chars)})
+                first = next(chars) # a failure before the first character can still be a 500
+            except GenerationFailed as e:
+                return self.send_json(500, {'error': f"generation failed: {e}"})
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            try:
+                for ch in itertools.chain([first], chars):
+                    data = ch.encode()
+                    self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+            except GenerationFailed:
+                self.close_connection = True # without the last chunk the client sees the body as cut short
+            except (BrokenPipeError, ConnectionResetError):
+                pass # the client went away; its remaining characters are dropped
+
+        def log_message(self, format, *args):
+            pass # one line per request would swamp the console under load
+
+    class Server(ThreadingHTTPServer):
+        request_queue_size = 128 # the default backlog of 5 resets connections under a burst of requests
+
+    server = Server(('127.0.0.1', port), Handler)
+    print(f"Serving on http://127.0.0.1:{port} (POST /generate, GET /metrics)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if args.serve:
+    model.load_state_dict(checkpoint['model'])
+    serve(BatchingGenerator(model, args.batch_window / 1000, args.max_batch, generate_forward), args.port)
+    sys.exit()
+
+if args.generate:
+    # Standalone generation from a checkpoint: no corpus, no training.
+    model.load_state_dict(checkpoint['model'])
+    prompts = args.prompt or ["To be, or not to be, "]
+    start = time.perf_counter()
+    samples = generate_batch(model, prompts, args.length, args.temperature, args.top_k, args.top_p, step_forward=generate_forward)
+    seconds = time.perf_counter() - start
+    for sample in samples:
+        print(sample + "\n")
+    print(f"Generated {len(prompts)} x {args.length} characters at {len(prompts) * args.length / seconds:.0f} tokens/sec")
+    sys.exit()
+
+
 
 # ------------------------------
-# 4. Training Loop
+# 5. Training Loop
 # ------------------------------
+# A resumed run starts from the checkpoint's weights; under DDP every rank loads them before wrapping.
+if args.resume:
+    if (checkpoint['batch_size'], checkpoint['seq_length']) != (batch_size, seq_length):
+        raise ValueError(f"the checkpoint was trained with batch_size {checkpoint['batch_size']} and seq_length "
+                         f"{checkpoint['seq_length']}; resuming needs the same batches")
+    model.load_state_dict(checkpoint['model'])
+
+# Under DDP the ranks start from rank 0's weights and average their gradients in backward().
+# Every rank's loss is a mean over the same number of tokens, so this is the gradient of the full batch.
+ddp_model = DistributedDataParallel(model) if distributed else model
+# Forward used for training (fixed local_batch_size x seq_length shapes).
+train_forward = compiled(ddp_model, "training") if compile_model else ddp_model
+# Forward-only pass for validation, with its own batch shape; it never needs DDP's gradient hooks.
+eval_forward = compiled(model, "evaluation") if compile_model else model
+optimizer = optim.Adam(model.parameters(), lr=learning_rate)
+criterion = nn.CrossEntropyLoss()
+
+# Where training starts: batch start_step of epoch start_epoch, with the streams' hidden state at that point.
+start_epoch, start_step, resume_hidden = 0, 0, None
+if args.resume:
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    start_epoch, start_step, resume_hidden = checkpoint['epoch'], checkpoint['step'], checkpoint['hidden']
+    torch.set_rng_state(checkpoint['rng_state'])
+    if checkpoint['cuda_rng_state'] is not None and device.type == 'cuda':
+        torch.cuda.set_rng_state_all(checkpoint['cuda_rng_state'])
+    log(f"Resuming at epoch {start_epoch + 1}, step {start_step}")
+
 # Determine number of training steps per epoch
-n_steps = len(train_data) // (batch_size * seq_length) #n_steps is the number of steps that will be required to see the full data once.
-print("Training steps per epoch:", n_steps)
+n_steps = (len(train_data) - 1) // (batch_size * seq_length) #n_steps is the number of steps that will be required to see the full data once.
+if steps_per_epoch:
+    n_steps = min(n_steps, steps_per_epoch)
+log("Training steps per epoch:", n_steps)
+
+def evaluate(stream, bf16=False):
+    """
+    Average loss per character over a stream such as val_stream, and the tokens/sec of the pass
+    (summed over ranks under DDP). bf16 runs it under bfloat16 autocast.
+    The loss is summed on the device and read once at the end.
+    """
+    model.eval()
+    start = time.perf_counter()
+    with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=bf16):
+        hidden = model.init_hidden(stream.shape[0])
+        total_loss = torch.zeros((), device=device)
+        steps = 0
+        for x, y in batches(stream, seq_length):
+            outputs, hidden = eval_forward(x, hidden)
+            total_loss += criterion(outputs.float().view(-1, vocab_size), y.reshape(-1))
+            steps += 1
+        avg_loss = total_loss.item() / steps
+    tokens_per_sec = steps * x.numel() / (time.perf_counter() - start)
+    return mean_over_ranks(avg_loss), mean_over_ranks(tokens_per_sec) * world_size
+
+
+def cpu_copy(obj):
+    """A CPU copy of the tensors in a (nested) state dict, which training can't change while it is written."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: cpu_copy(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_copy(v) for v in obj)
+    return obj
 
-for epoch in range(num_epochs):
+
+def gather_rows(t):
+    """Under DDP, a (num_layers, local_batch_size, hidden_size) state from every rank, joined into all batch_size streams."""
+    if not distributed:
+        return t
+    parts = [torch.empty_like(t) for _ in range(world_size)]
+    dist.all_gather(parts, t.contiguous())
+    return torch.cat(parts, dim=1)
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints with torch.save in a background thread, so training never waits on disk.
+    At most one checkpoint waits for the thread; if a newer one arrives first, the older one is dropped.
+    """
+    def __init__(self, directory, keep=keep_checkpoints):
+        self.directory = directory
+        self.keep = keep
+        self.queue = queue.Queue(maxsize=1)
+        os.makedirs(directory, exist_ok=True)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, state):
+        try:
+            self.queue.get_nowait() # drop a checkpoint that has not been written yet
+        except queue.Empty:
+            pass
+        self.queue.put_nowait(state)
+
+    def close(self):
+        """Write whatever is still queued and stop the thread."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while (state := self.queue.get()) is not None:
+            # A failed write is reported and skipped; if it ended the thread, close() would wait forever.
+            try:
+                self._write(state)
+            except Exception as e:
+                print(f"Could not write the checkpoint of epoch {state['epoch']}, step {state['step']}: {e}", file=sys.stderr)
+
+    def _write(self, state):
+        path = os.path.join(self.directory, f"ckpt_e{state['epoch']:03d}_s{state['step']:06d}.pt")
+        # Write to a temporary file and rename, so a kill mid-write never leaves a broken checkpoint.
+        torch.save(state, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        for old in sorted(glob.glob(os.path.join(self.directory, 'ckpt_*.pt')))[:-self.keep]:
+            os.remove(old)
+
+
+def save_checkpoint(writer, epoch, step, hidden=None):
+    """
+    Hand a copy of the training state to writer, to resume at batch `step` of `epoch` with the streams' `hidden` state.
+    Under DDP every rank has to call this (the hidden states are gathered), and only rank 0 has a writer.
+    """
+    hidden = tuple(gather_rows(h.float()) for h in hidden) if hidden is not None else None
+    if writer is None:
+        return
+    writer.save(cpu_copy({
+        'model': model.state_dict(), 'optimizer': optimizer.state_dict(),
+        'epoch': epoch, 'step': step, 'hidden': hidden,
+        'rng_state': torch.get_rng_state(),
+        'cuda_rng_state': torch.cuda.get_rng_state_all() if device.type == 'cuda' else None,
+        'chars': chars, 'hidden_size': hidden_size, 'num_layers': num_layers,
+        'batch_size': batch_size, 'seq_length': seq_length,
+    }))
+
+
+def labelled_batches(batch_iter, name="get_batch"):
+    """The batches of batch_iter, with the time spent producing each one labelled in profiler traces."""
+    batch_iter = iter(batch_iter)
+    while True:
+        with record_function(name):
+            batch = next(batch_iter, None)
+        if batch is None:
+            return
+        yield batch
+
+
+def start_profiler(directory, skip, active):
+    """
+    A started torch.profiler.profile that skips `skip` steps, warms up for 2 and records `active`; call .step() after
+    every training step. When the window ends it writes to directory, per rank: a Chrome trace
+    (open in chrome://tracing or Perfetto), summary tables by time and by memory, and on CUDA a memory snapshot
+    (open in pytorch.org/memory_viz). On the CPU, the memory columns of the tables are the memory view.
+    """
+    os.makedirs(directory, exist_ok=True)
+    cuda = device.type == 'cuda'
+    if cuda:
+        torch.cuda.memory._record_memory_history(max_entries=100000)
+
+    def write(prof):
+        prof.export_chrome_trace(os.path.join(directory, f"trace_rank{rank}.json"))
+        averages = prof.key_averages()
+        time_key = 'self_cuda_time_total' if cuda else 'self_cpu_time_total'
+        with open(os.path.join(directory, f"summary_rank{rank}.txt"), 'w') as f:
+            f.write(f"Training steps {skip + 3}-{skip + 2 + active}, by {time_key}:\n")
+            f.write(averages.table(sort_by=time_key, row_limit=40))
+            f.write("\n\nBy self_cpu_memory_usage:\n")
+            f.write(averages.table(sort_by='self_cpu_memory_usage', row_limit=20))
+            f.write("\n\nBy input shapes:\n")
+            f.write(prof.key_averages(group_by_input_shape=True).table(sort_by=time_key, row_limit=20))
+        if cuda:
+            torch.cuda.memory._dump_snapshot(os.path.join(directory, f"memory_snapshot_rank{rank}.pickle"))
+            torch.cuda.memory._record_memory_history(enabled=None)
+        log(f"Profile of {active} training steps written to {directory}/")
+
+    prof = torch.profiler.profile(
+        activities=[ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if cuda else []),
+        schedule=torch.profiler.schedule(skip_first=skip, wait=0, warmup=2, active=active, repeat=1),
+        on_trace_ready=write, record_shapes=True, profile_memory=True)
+    prof.start()
+    return prof
+
+
+writer = CheckpointWriter(checkpoint_dir) if is_main and checkpoint_dir else None
+profiler = start_profiler(args.profile, args.profile_start, args.profile_steps) if args.profile else None
+profile_end = args.profile_start + 2 + args.profile_steps # steps after which the profiler has written its window
+profiled_steps = 0
+avg_loss = train_tokens_per_sec = None # stay None if the run resumed from the checkpoint of the last epoch
+for epoch in range(start_epoch, num_epochs):
     model.train()
-    hidden = model.init_hidden(batch_size)
-    total_loss = 0.0
+    first_step = start_step if epoch == start_epoch else 0
+    hidden = model.init_hidden(local_batch_size)
+    if first_step:
+        # Mid-epoch resume: this rank's rows of the saved hidden state.
+        hidden = tuple(h[:, rank * local_batch_size:(rank + 1) * local_batch_size].to(device) for h in resume_hidden)
+    # Summed on the device; reading it back every step would wait for the step to finish.
+    total_loss = torch.zeros((), device=device)
+    start = time.perf_counter()
 
     # Create a new batch generator for each epoch
-    for step, (x_batch, y_batch) in enumerate(get_batch(train_data, batch_size, seq_length)):
+    for step, (x_batch, y_batch) in enumerate(labelled_batches(batches(train_stream, seq_length, first_step)), start=first_step):
         # enumerate returns a list of index and the corresponding x and y values, the input of one loop of training and the expected output.
         
         # Detach hidden state to prevent backpropagating through the entire history
         #This prevents infinite loop in back-prop?
         # This back-prop calc for RNN is complicated and I need to understand exactly how it is done in terms of the LSTM equations.
-        hidden = tuple([h.detach() for h in hidden])
+        # Under autocast the LSTM hands back a bfloat16 state; carry it over in fp32.
+        hidden = tuple([h.detach().float() for h in hidden])
         optimizer.zero_grad()
-        outputs, hidden = model(x_batch, hidden)
+        with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=bf16_autocast):
+            outputs, hidden = train_forward(x_batch, hidden)
         # Reshape outputs to (batch_size*seq_length, vocab_size) for CrossEntropyLoss
-        loss = criterion(outputs.view(-1, vocab_size), y_batch.view(-1))
-        loss.backward()
-        optimizer.step()
+        # The loss is computed in fp32 even when the forward pass ran in bfloat16.
+        with record_function("loss"):
+            loss = criterion(outputs.float().view(-1, vocab_size), y_batch.reshape(-1)) # y_batch is a view of the stream, not contiguous
+        with record_function("backward"):
+            loss.backward()
+        with record_function("optimizer"):
+            optimizer.step()
         
-        total_loss += loss.item()
+        total_loss += loss.detach()
+        if profiler is not None:
+            profiler.step()
+            if (profiled_steps := profiled_steps + 1) == profile_end:
+                profiler.stop()
+                profiler = None
         
         if (step + 1) % 100 == 0:
-            print(f"Epoch [{epoch+1}/{num_epochs}], Step [{step+1}/{n_steps}], Loss: {loss.item():.4f}")
+            log(f"Epoch [{epoch+1}/{num_epochs}], Step [{step+1}/{n_steps}], Loss: {mean_over_ranks(loss.item()):.4f}")
+        if checkpoint_every and (step + 1) % checkpoint_every == 0 and step + 1 < n_steps:
+            save_checkpoint(writer, epoch, step + 1, hidden)
+        if step + 1 >= n_steps:
+            break # only reached early with steps_per_epoch
     
-    avg_loss = total_loss / n_steps
-    print(f"Epoch [{epoch+1}/{num_epochs}] Average Training Loss: {avg_loss:.4f}")
+    avg_loss = mean_over_ranks(total_loss.item() / (step + 1 - first_step))
+    train_tokens_per_sec = mean_over_ranks((step + 1 - first_step) * x_batch.numel() / (time.perf_counter() - start)) * world_size
+    log(f"Epoch [{epoch+1}/{num_epochs}] Average Training Loss: {avg_loss:.4f}, {train_tokens_per_sec:.0f} tokens/sec")
     
     # ------------------------------
     # Validation after each epoch
     # ------------------------------
-    model.eval()
-    with torch.no_grad():
-        val_hidden = model.init_hidden(batch_size)
-        val_loss = 0.0
-        val_steps = len(val_data) // (batch_size * seq_length)
-        for x_val, y_val in get_batch(val_data, batch_size, seq_length):
-            val_hidden = tuple([h.detach() for h in val_hidden])
-            outputs, val_hidden = model(x_val, val_hidden)
-            loss = criterion(outputs.view(-1, vocab_size), y_val.view(-1))
-            val_loss += loss.item()
-            # Limit the number of validation steps to cover the dataset once
-            if (val_steps := val_steps - 1) <= 0:
-                break
-        avg_val_loss = val_loss / (len(val_data) // (batch_size * seq_length))
-        print(f"Epoch [{epoch+1}/{num_epochs}] Validation Loss: {avg_val_loss:.4f}")
-
-# ------------------------------
-# 5. Text Generation
-# ------------------------------
-def generate_text(model, start_str, gen_length=200, temperature=1.0):
-    """
-    Generate text given a starting string.
-    - temperature: controls randomness. Lower -> more deterministic.
-    """
-    model.eval()
-    # Convert start string to tensor indices
-    input_seq = torch.tensor([stoi[c] for c in start_str], dtype=torch.long).unsqueeze(0).to(device)
-    hidden = model.init_hidden(1)
-    generated = start_str
-
-    with torch.no_grad():
-        for _ in range(gen_length):
-            outputs, hidden = model(input_seq, hidden)
-            # Get logits for the last character in the sequence
-            logits = outputs[:, -1, :] / temperature
-            # Sample from the distribution
-            probs = torch.softmax(logits, dim=-1)
-            next_idx = torch.multinomial(probs, num_samples=1).item()
-            next_char = itos[next_idx]
-            generated += next_char
-            # Prepare next input (use only the most recent predicted character)
-            input_seq = torch.tensor([[next_idx]], dtype=torch.long).to(device)
-    return generated
+    avg_val_loss, val_tokens_per_sec = evaluate(val_stream, bf16_autocast)
+    log(f"Epoch [{epoch+1}/{num_epochs}] Validation Loss: {avg_val_loss:.4f}, {val_tokens_per_sec:.0f} tokens/sec")
+    if bf16_autocast:
+        # Same validation pass in fp32, to see what bfloat16 buys and what it costs.
+        fp32_val_loss, fp32_tokens_per_sec = evaluate(val_stream, False)
+        log(f"Epoch [{epoch+1}/{num_epochs}] bf16 speedup over fp32 (validation pass): {val_tokens_per_sec / fp32_tokens_per_sec:.2f}x, "
+              f"Validation Loss bf16 - fp32: {avg_val_loss - fp32_val_loss:+.4f}")
+    save_checkpoint(writer, epoch + 1, 0)
+
+if start_epoch >= num_epochs:
+    # Resumed from the checkpoint of the last epoch: nothing to train, but --results still gets the validation loss.
+    log(f"The checkpoint is from the end of epoch {start_epoch}; nothing left to train")
+    avg_val_loss, val_tokens_per_sec = evaluate(val_stream, bf16_autocast)
 
+if writer is not None:
+    writer.close()
+if profiler is not None:
+    # Training ended inside the window; write what was recorded.
+    profiler.stop()
+
+# Training is done; generation and export below run on rank 0 only.
+if distributed:
+    dist.destroy_process_group()
+    if not is_main:
+        sys.exit()
+
+if args.results:
+    # For sweeps: the numbers of the last epoch, and the most memory this process (rank 0) ever held.
+    peak_memory = (torch.cuda.max_memory_allocated() if device.type == 'cuda'
+                   else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024) # ru_maxrss is in KiB on Linux
+    with open(args.results, 'w') as f:
+        json.dump({'hyperparameters': hyperparameters, 'train_loss': avg_loss, 'val_loss': avg_val_loss,
+                   'train_tokens_per_sec': train_tokens_per_sec, 'val_tokens_per_sec': val_tokens_per_sec,
+                   'peak_memory_mb': peak_memory / 2**20}, f, indent=2)
+    sys.exit()
+
+
+# ------------------------------
+# 6. Generate samples
+# ------------------------------
 # Generate and print text using a seed string
 seed_text = "To be, or not to be, "
-generated_text = generate_text(model, start_str=seed_text, gen_length=300, temperature=0.8)
+start = time.perf_counter()
+generated_text = generate_text(model, start_str=seed_text, gen_length=300, temperature=0.8, step_forward=generate_forward)
 print("\nGenerated Text:")
 print(generated_text)
+print(f"Generated 300 characters at {300 / (time.perf_counter() - start):.0f} tokens/sec")
+
+# Several prompts decoded together, each with its own sampling settings.
+prompts = ["ROMEO:", "JULIET:\nO ", "First Citizen:\n", "KING HENRY"]
+start = time.perf_counter()
+samples = generate_batch(model, prompts, gen_length=300, temperature=[0.8, 0.8, 1.0, 0.5],
+                         top_k=[0, 10, 0, 5], top_p=[0.9, 1.0, 0.95, 1.0], step_forward=generate_forward)
+seconds = time.perf_counter() - start
+for sample in samples:
+    print("\n" + sample)
+print(f"Generated {len(prompts)} x 300 characters at {len(prompts) * 300 / seconds:.0f} tokens/sec")
+
+# ------------------------------
+# 7. Int8 inference on the CPU
+# ------------------------------
+if quantize_int8:
+    export_int8(model, int8_path)
+    fp32_cpu = CharRNN(vocab_size, hidden_size, num_layers)
+    fp32_cpu.load_state_dict(model.state_dict())
+    for name, m in (("fp32", fp32_cpu), ("int8", load_int8(int8_path))):
+        generate_text(m, start_str=seed_text, gen_length=10)  # warm up
+        start = time.perf_counter()
+        generated_text = generate_text(m, start_str=seed_text, gen_length=300, temperature=0.8)
+        print(f"\n{name}: {state_dict_bytes(m) / 2**20:.2f} MiB of weights, "
+              f"{300 / (time.perf_counter() - start):.0f} tokens/sec on the CPU")
+        print(generated_text)
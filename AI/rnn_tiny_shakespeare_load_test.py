@@ -0,0 +1,90 @@
+# Load test for the generation server of rnn_tiny_shakespeare.py:
+#   python rnn_tiny_shakespeare.py --serve checkpoints/ckpt_e020_s000000.pt
+#   python rnn_tiny_shakespeare_load_test.py --concurrency 32 --requests 256
+# Only the standard library is needed here.
+import argparse
+import http.client
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+prompts = ["ROMEO:", "JULIET:\nO ", "First Citizen:\n", "KING HENRY", "To be, or not to be, ", "MENENIUS:\nWhat"]
+
+
+def one_request(url, i, length, stream, temperature):
+    """Send the i-th request; returns (seconds to the first character, seconds in total, characters received)."""
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=300)
+    body = json.dumps({'prompt': prompts[i % len(prompts)], 'length': length, 'temperature': temperature,
+                       'stream': stream})
+    start = time.perf_counter()
+    try:
+        conn.request('POST', '/generate', body, {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        if response.status != 200:
+            raise RuntimeError(f"HTTP {response.status}: {response.read().decode(errors='replace')}")
+        if stream:
+            first = response.read(1) # http.client undoes the chunked encoding
+            first_token = time.perf_counter() - start
+            received = len((first + response.read()).decode())
+        else:
+            received = len(json.loads(response.read())['text'])
+            first_token = time.perf_counter() - start
+        return first_token, time.perf_counter() - start, received
+    finally:
+        conn.close()
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, len(values) * q // 100)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send concurrent completion requests to a local rnn_tiny_shakespeare server.")
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--concurrency', type=int, default=16, help="requests in flight at once")
+    parser.add_argument('--requests', type=int, default=128, help="requests in total")
+    parser.add_argument('--length', type=int, default=200, help="characters per request")
+    parser.add_argument('--temperature', type=float, default=0.8)
+    parser.add_argument('--no-stream', action='store_true', help="wait for whole responses instead of streaming them")
+    args = parser.parse_args()
+    url = urlparse(args.url)
+
+    results, errors = [], []
+    lock = threading.Lock()
+
+    def run(i):
+        try:
+            result = one_request(url, i, args.length, not args.no_stream, args.temperature)
+        except Exception as e:
+            with lock:
+                errors.append(f"{type(e).__name__}: {e}")
+            return
+        with lock:
+            results.append(result)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(run, range(args.requests)))
+    seconds = time.perf_counter() - start
+
+    print(f"{len(results)} requests ok, {len(errors)} failed in {seconds:.2f} s, concurrency {args.concurrency}")
+    for error in sorted(set(errors)):
+        print(f"  {errors.count(error)} x {error}")
+    if results:
+        first_token, total, received = zip(*results)
+        print(f"{len(results) / seconds:.1f} requests/sec, {sum(received) / seconds:.0f} characters/sec")
+        for name, values in (("first character", first_token), ("whole response", total)):
+            print(f"{name} latency ms: p50 {1000 * percentile(values, 50):.0f}, p95 {1000 * percentile(values, 95):.0f}, "
+                  f"p99 {1000 * percentile(values, 99):.0f}")
+
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=10)
+    conn.request('GET', '/metrics')
+    print("server metrics:", json.dumps(json.loads(conn.getresponse().read()), indent=2))
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
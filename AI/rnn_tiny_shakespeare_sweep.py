@@ -0,0 +1,131 @@
+# Hyperparameter sweep over rnn_tiny_shakespeare.py on one host.
+#   python rnn_tiny_shakespeare_sweep.py sweep.json --workers 4
+# sweep.json holds a grid, every combination of which is run:
+#   {"fixed": {"num_epochs": 1, "steps_per_epoch": 100},
+#    "grid": {"hidden_size": [128, 256], "num_layers": [1, 2], "learning_rate": [0.002, 0.005]}}
+# or a random search, with "trials" samples; a list is a choice, {"uniform"/"log_uniform": [low, high]} a range:
+#   {"fixed": {...}, "trials": 16,
+#    "random": {"hidden_size": [128, 256, 512], "seq_length": [50, 100], "learning_rate": {"log_uniform": [1e-4, 1e-2]}}}
+# Every run is its own process, pinned to its own share of the cores, and writes <out>/run_NNN.{log,json};
+# the table of all runs goes to <out>/results.csv and is printed sorted by validation loss.
+import argparse
+import csv
+import itertools
+import json
+import math
+import os
+import queue
+import random
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rnn_tiny_shakespeare.py')
+columns = ['val_loss', 'train_loss', 'train_tokens_per_sec', 'val_tokens_per_sec', 'peak_memory_mb']
+
+
+def configurations(spec, seed):
+    """The hyperparameter settings of every run in the sweep spec, fixed settings included."""
+    fixed = spec.get('fixed', {})
+    if 'grid' in spec:
+        names = list(spec['grid'])
+        for values in itertools.product(*(spec['grid'][name] for name in names)):
+            yield {**fixed, **dict(zip(names, values))}
+    elif 'random' in spec:
+        rng = random.Random(seed)
+        for _ in range(spec.get('trials', 8)):
+            config = dict(fixed)
+            for name, choice in spec['random'].items():
+                if isinstance(choice, list):
+                    config[name] = rng.choice(choice)
+                elif 'uniform' in choice:
+                    config[name] = rng.uniform(*choice['uniform'])
+                elif 'log_uniform' in choice:
+                    low, high = choice['log_uniform']
+                    config[name] = math.exp(rng.uniform(math.log(low), math.log(high)))
+                else:
+                    raise ValueError(f"{name}: expected a list, uniform or log_uniform, got {choice}")
+            yield config
+    else:
+        raise ValueError("the sweep spec needs a 'grid' or a 'random' section")
+
+
+def core_slots(workers, threads):
+    """`workers` disjoint sets of `threads` cores each (wrapping around if there are too few cores)."""
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    return [{cores[(w * threads + t) % len(cores)] for t in range(threads)} for w in range(workers)]
+
+
+def run(i, config, out_dir, slots):
+    """Run one configuration on a free core slot; returns its results, or the error if it failed."""
+    results_path = os.path.join(out_dir, f"run_{i:03d}.json")
+    cmd = [sys.executable, script, '--results', results_path,
+           *(f"--set={name}={value!r}" for name, value in config.items())]
+    cores = slots.get()
+    env = dict(os.environ, OMP_NUM_THREADS=str(len(cores)), MKL_NUM_THREADS=str(len(cores)))
+    try:
+        with open(os.path.join(out_dir, f"run_{i:03d}.log"), 'w') as log:
+            proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+            # Pin the run to its cores, so the workers don't take cores from each other. This is done from
+            # here rather than with preexec_fn, which isn't safe in threads; the child is still importing
+            # torch, so the threads it starts later inherit the affinity.
+            if hasattr(os, 'sched_setaffinity'):
+                try:
+                    os.sched_setaffinity(proc.pid, cores)
+                except ProcessLookupError:  # it already exited; wait() reports how
+                    pass
+            returncode = proc.wait()
+    finally:
+        slots.put(cores)
+    if returncode != 0:
+        return {'run': i, **config, 'error': f"exit code {returncode}, see run_{i:03d}.log"}
+    with open(results_path) as f:
+        results = json.load(f)
+    print(f"run {i:03d} done: val_loss {results['val_loss']:.4f}, {config}", flush=True)
+    return {'run': i, **config, **{column: results[column] for column in columns}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run short rnn_tiny_shakespeare.py trainings over a grid or random "
+                                                 "search of hyperparameters, several at a time.")
+    parser.add_argument('spec', help="JSON sweep spec (see the top of this file)")
+    parser.add_argument('--workers', type=int, default=2, help="runs at the same time")
+    parser.add_argument('--threads', type=int, default=None, help="cores and threads per run (default: cores // workers)")
+    parser.add_argument('--out', default='sweep', help="directory for logs and results")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the random search")
+    args = parser.parse_args()
+
+    with open(args.spec) as f:
+        spec = json.load(f)
+    # Sweeps compare configurations; they don't need checkpoints unless the spec asks for them.
+    spec.setdefault('fixed', {}).setdefault('checkpoint_dir', None)
+    configs = list(configurations(spec, args.seed))
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    slots = queue.Queue()
+    for cores in core_slots(args.workers, threads):
+        slots.put(cores)
+    os.makedirs(args.out, exist_ok=True)
+    print(f"{len(configs)} runs, {args.workers} at a time with {threads} threads each")
+
+    with ThreadPoolExecutor(args.workers) as pool:
+        rows = list(pool.map(lambda job: run(*job, args.out, slots), enumerate(configs)))
+
+    names = sorted({name for config in configs for name in config})
+    header = ['run', *names, *columns, 'error']
+    with open(os.path.join(args.out, 'results.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, header)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    rows.sort(key=lambda row: row.get('val_loss', math.inf))
+    shown = ['run', *(name for name in names if len({str(c.get(name)) for c in configs}) > 1), *columns]
+    table = [[str(row.get(c, '')) if not isinstance(row.get(c), float) else f"{row[c]:.4g}" for c in shown] for row in rows]
+    widths = [max(len(c), *(len(line[i]) for line in table)) for i, c in enumerate(shown)]
+    print("\n" + "  ".join(c.rjust(w) for c, w in zip(shown, widths)))
+    for row, line in zip(rows, table):
+        print("  ".join(v.rjust(w) for v, w in zip(line, widths)) + (f"  {row['error']}" if 'error' in row else ''))
+    print(f"\nResults written to {os.path.join(args.out, 'results.csv')}")
+
+
+if __name__ == '__main__':
+    main()
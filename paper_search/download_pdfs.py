@@ -7,17 +7,26 @@ Assumes DOIs look like:
   - https://doi.org/10.48550/arXiv:2401.11595
   - arXiv:2401.11595
 The script extracts the arXiv identifier and fetches https://arxiv.org/pdf/<id>.pdf.
+Several PDFs are fetched at once (--jobs), with per-host caps on requests in flight
+and requests per second; the output is printed in the order of doi.txt regardless.
+A download that breaks off is resumed from its .part file with an HTTP Range request,
+on the next attempt or the next run.
 """
 from __future__ import annotations
 
 import argparse
+import contextlib
+import json
 import pathlib
 import re
 import sys
+import threading
 import time
 import urllib.error
+import urllib.parse
 import urllib.request
-from typing import Iterable, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 
 ARXIV_ID_RE = re.compile(
@@ -57,66 +66,222 @@ def iter_dois(path: pathlib.Path) -> Iterable[str]:
                 yield line
 
 
-def download_pdf(arxiv_id: str, dest: pathlib.Path, retries: int = 2, delay: float = 1.5) -> bool:
-    """Download a single arXiv PDF; returns True on success."""
+class HostLimiter:
+    """Caps requests in flight and request starts per second, separately for every host."""
+
+    def __init__(self, max_in_flight: int = 4, per_second: float = 2.0):
+        self.max_in_flight = max_in_flight
+        self.interval = 1.0 / per_second if per_second > 0 else 0.0
+        self.lock = threading.Lock()
+        self.in_flight: Dict[str, threading.BoundedSemaphore] = {}
+        self.next_start: Dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def slot(self, url: str) -> Iterator[None]:
+        """Hold one of the host's in-flight slots, starting no sooner than its rate allows."""
+        host = urllib.parse.urlsplit(url).hostname or ""
+        with self.lock:
+            semaphore = self.in_flight.setdefault(host, threading.BoundedSemaphore(self.max_in_flight))
+        with semaphore:
+            with self.lock:
+                # Reserve the next start time for this host, then wait for it outside the lock.
+                now = time.monotonic()
+                start = max(now, self.next_start.get(host, now))
+                self.next_start[host] = start + self.interval
+            time.sleep(max(0.0, start - time.monotonic()))
+            yield
+
+
+def stderr_log(message: str) -> None:
+    print(message, file=sys.stderr)
+
+
+CONTENT_RANGE_RE = re.compile(r"bytes (\d+)-\d+/(\d+|\*)")
+
+
+def discard_partial(tmp_path: pathlib.Path, meta_path: pathlib.Path) -> None:
+    tmp_path.unlink(missing_ok=True)
+    meta_path.unlink(missing_ok=True)
+
+
+def resume_point(tmp_path: pathlib.Path, meta_path: pathlib.Path) -> Tuple[int, Dict[str, Any]]:
+    """Bytes already in tmp_path and the validators of the response they came from; (0, {}) to start over."""
+    try:
+        meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        return tmp_path.stat().st_size, meta
+    except (OSError, ValueError):
+        # No record of what the .part holds (or no .part), so it can't be resumed safely.
+        discard_partial(tmp_path, meta_path)
+        return 0, {}
+
+
+def resumes(resp: Any, offset: int, meta: Dict[str, Any]) -> bool:
+    """Whether resp is the rest of the file that the .part holds the first offset bytes of."""
+    m = CONTENT_RANGE_RE.fullmatch(resp.headers.get("Content-Range", ""))
+    if resp.status != 206 or not m or int(m.group(1)) != offset:
+        return False
+    if meta.get("length") is not None and m.group(2) != "*" and int(m.group(2)) != meta["length"]:
+        return False
+    etag = resp.headers.get("ETag")
+    return not (meta.get("etag") and etag and etag != meta["etag"])
+
+
+def download_pdf(
+    arxiv_id: str,
+    dest: pathlib.Path,
+    retries: int = 2,
+    delay: float = 1.5,
+    limiter: Optional[HostLimiter] = None,
+    log: Callable[[str], None] = stderr_log,
+) -> bool:
+    """Download a single arXiv PDF; returns True on success.
+
+    With a limiter, every request waits for a slot of its host. Messages go to log (stderr by default).
+    A broken-off download keeps its .part file, plus the response's ETag, Last-Modified and length
+    in <dest>.part.json. The next attempt asks for the remaining bytes with a Range request
+    (If-Range makes the server send the whole file instead if it changed). A response that is not
+    the matching rest, such as a plain 200, replaces the .part from byte zero.
+    """
     url = f"https://arxiv.org/pdf/{arxiv_id}.pdf"
     tmp_path = dest.with_suffix(".part")
+    meta_path = tmp_path.with_name(tmp_path.name + ".json")
+    limiter = limiter or HostLimiter(max_in_flight=1, per_second=0)
     for attempt in range(retries + 1):
+        offset, meta = resume_point(tmp_path, meta_path)
+        request = urllib.request.Request(url)
+        if offset:
+            request.add_header("Range", f"bytes={offset}-")
+            # If-Range needs a strong validator: the ETag unless it is weak (W/...), else Last-Modified.
+            etag = meta.get("etag")
+            validator = etag if etag and not etag.startswith("W/") else meta.get("last_modified")
+            if validator:
+                request.add_header("If-Range", validator)
         try:
-            with urllib.request.urlopen(url, timeout=30) as resp, tmp_path.open("wb") as out:
-                while True:
-                    chunk = resp.read(1024 * 64)
-                    if not chunk:
-                        break
-                    out.write(chunk)
+            if offset and offset == meta.get("length"):
+                pass  # the last run got every byte but stopped before the rename
+            else:
+                with limiter.slot(url), urllib.request.urlopen(request, timeout=30) as resp:
+                    if offset and resumes(resp, offset, meta):
+                        mode = "ab"
+                    elif resp.status == 206:
+                        # Part of some other version of the file: useless both appended and on its own.
+                        discard_partial(tmp_path, meta_path)
+                        raise OSError(f"server sent a range that does not continue the .part at byte {offset}")
+                    else:
+                        if offset:
+                            log(f"[{arxiv_id}] server did not resume at byte {offset}; downloading from the start")
+                        length = resp.headers.get("Content-Length")
+                        meta = {
+                            "etag": resp.headers.get("ETag"),
+                            "last_modified": resp.headers.get("Last-Modified"),
+                            "length": int(length) if length and length.isdigit() else None,
+                        }
+                        meta_path.write_text(json.dumps(meta), encoding="utf-8")
+                        mode = "wb"
+                    with tmp_path.open(mode) as out:
+                        while True:
+                            chunk = resp.read(1024 * 64)
+                            if not chunk:
+                                break
+                            out.write(chunk)
+                size = tmp_path.stat().st_size
+                if meta.get("length") is not None and size != meta["length"]:
+                    raise OSError(f"connection closed at byte {size} of {meta['length']}")
             tmp_path.rename(dest)
+            meta_path.unlink(missing_ok=True)
             return True
         except urllib.error.HTTPError as e:
-            print(f"[{arxiv_id}] HTTP {e.code} when fetching {url}", file=sys.stderr)
+            if e.code == 416:
+                # The .part doesn't fit the file on the server any more; fetch it whole.
+                discard_partial(tmp_path, meta_path)
+                if attempt < retries:
+                    log(f"[{arxiv_id}] HTTP 416 when resuming at byte {offset}; downloading from the start")
+                    continue
+            # Any other status (e.g. 429 or 503) says nothing about the .part; it stays for a later run.
+            log(f"[{arxiv_id}] HTTP {e.code} when fetching {url}")
             break  # HTTP errors are unlikely to succeed on retry
         except Exception as e:
-            if tmp_path.exists():
-                tmp_path.unlink(missing_ok=True)
+            # The .part stays, so the next attempt (or the next run) continues where this one stopped.
             if attempt < retries:
-                print(f"[{arxiv_id}] error: {e}; retrying in {delay}s...", file=sys.stderr)
+                log(f"[{arxiv_id}] error: {e}; retrying in {delay}s...")
                 time.sleep(delay)
                 continue
-            print(f"[{arxiv_id}] failed after {retries + 1} attempts: {e}", file=sys.stderr)
+            log(f"[{arxiv_id}] failed after {retries + 1} attempts: {e}")
     return False
 
 
+def fetch(arxiv_id: str, dest: pathlib.Path, limiter: HostLimiter) -> Tuple[bool, List[str]]:
+    """download_pdf in a worker thread; its messages are returned so they can be printed in input order."""
+    messages: List[str] = []
+    return download_pdf(arxiv_id, dest, limiter=limiter, log=messages.append), messages
+
+
 def main() -> int:
     parser = argparse.ArgumentParser(description="Download PDFs from arXiv DOIs listed in a file.")
     parser.add_argument("-i", "--input", type=pathlib.Path, default=pathlib.Path("doi.txt"), help="path to DOI list")
     parser.add_argument("-o", "--out-dir", type=pathlib.Path, default=pathlib.Path("pdfs"), help="where to save PDFs")
     parser.add_argument("--overwrite", action="store_true", help="re-download existing PDFs")
+    parser.add_argument("-j", "--jobs", type=int, default=8, help="downloads running at once")
+    parser.add_argument("--max-per-host", type=int, default=4, help="requests in flight to one host")
+    parser.add_argument("--rps", type=float, default=2.0, help="request starts per second to one host (0: no limit)")
     args = parser.parse_args()
+    if args.jobs < 1 or args.max_per_host < 1:
+        parser.error("--jobs and --max-per-host must be at least 1")
 
     if not args.input.exists():
         print(f"Input file not found: {args.input}", file=sys.stderr)
         return 1
 
     args.out_dir.mkdir(parents=True, exist_ok=True)
+    limiter = HostLimiter(args.max_per_host, args.rps)
 
+    # One entry per input line, in order: the id, its destination and the download it waits for.
+    # A repeated id shares the first download instead of fetching again: it is reported as already downloaded
+    # if that succeeded, and as failed (without a second attempt) if it didn't.
+    lines: List[Tuple[str, Optional[str], Optional[pathlib.Path], Optional[Future], bool]] = []
+    downloads: Dict[str, Future] = {}
     successes = 0
     total = 0
-    for raw in iter_dois(args.input):
-        total += 1
-        arxiv_id = extract_arxiv_id(raw)
-        if not arxiv_id:
-            print(f"[skip] could not parse arXiv id from line: {raw.strip()}", file=sys.stderr)
-            continue
-
-        dest = args.out_dir / f"{arxiv_id}.pdf"
-        if dest.exists() and not args.overwrite:
-            print(f"[skip] already downloaded: {dest}")
-            successes += 1
-            continue
-
-        ok = download_pdf(arxiv_id, dest)
-        if ok:
-            print(f"[ok] {arxiv_id} -> {dest}")
-            successes += 1
+    pool = ThreadPoolExecutor(max_workers=args.jobs)
+    try:
+        for raw in iter_dois(args.input):
+            arxiv_id = extract_arxiv_id(raw)
+            if not arxiv_id:
+                lines.append((raw, None, None, None, False))
+                continue
+            dest = args.out_dir / f"{arxiv_id}.pdf"
+            repeated = arxiv_id in downloads
+            if not repeated and not (dest.exists() and not args.overwrite):
+                downloads[arxiv_id] = pool.submit(fetch, arxiv_id, dest, limiter)
+            lines.append((raw, arxiv_id, dest, downloads.get(arxiv_id), repeated))
+
+        for raw, arxiv_id, dest, download, repeated in lines:
+            total += 1
+            if not arxiv_id:
+                print(f"[skip] could not parse arXiv id from line: {raw.strip()}", file=sys.stderr)
+                continue
+
+            if download is None or repeated:
+                ok = download is None or download.result()[0]
+                if ok:
+                    print(f"[skip] already downloaded: {dest}")
+                    successes += 1
+                else:
+                    print(f"[fail] {arxiv_id}: repeats an earlier line whose download failed", file=sys.stderr)
+                continue
+
+            ok, messages = download.result()
+            for message in messages:
+                print(message, file=sys.stderr)
+            if ok:
+                print(f"[ok] {arxiv_id} -> {dest}")
+                successes += 1
+    except KeyboardInterrupt:
+        # Drop the queued downloads instead of waiting for them; the running ones finish, or keep their .part.
+        pool.shutdown(wait=False, cancel_futures=True)
+        print(f"Interrupted: {successes}/{total} PDFs downloaded.", file=sys.stderr)
+        return 130
+    pool.shutdown()
     print(f"Done: {successes}/{total} PDFs downloaded.")
     return 0 if successes else 1
 